@@ -18,22 +18,21 @@ import gffutils
 import hgvs
 import pandas as pd
 from pyfaidx import Fasta
+from pysam import VariantFile
 import streamlit as st
 from st_aggrid import AgGrid, JsCode, GridOptionsBuilder,ColumnsAutoSizeMode
 import xlsxwriter
 from io import BytesIO
+import pickle
+from primer4.cache import DiskCache, data_fingerprint, design_key
 from primer4.df_inSilPcr import InserInSilPCRlink
 from primer4.models import Variant, ExonDelta, SingleExon, ExonSpread, Template
-from primer4.design import (
-    design_primers,
-    check_for_multiple_amplicons,
-    sort_by_penalty,
-    dereplicate,
-    )
 from primer4.hacks import download_button
+from primer4.kmers import load_mappability
+from primer4.parallel import DesignPool
+from primer4.pipeline import check_streamed
 from primer4.utils import (
     log,
-    mask_sequence,
     reconstruct_mrna,
     sync_tx_with_feature_db,
     )
@@ -46,20 +45,29 @@ def gimme_some_primers(method, code, fp_genome, genome, hdp, db, vardbs, params,
     gimme_some_primers('sanger', 'NM_000546.6:c.215C>G', ...)
     gimme_some_primers('qpcr', ('NM_001145408.2', 6), ...)
     gimme_some_primers('mrna', ('NM_000546.6', 6, 7), ...)
+
+    Results are cached on disk; the same query with the same settings against
+    the same data files is served from there (see primer4/cache.py).
     '''
+    cache = result_cache(params['cache']['path'], params['cache']['max_size_mb'])
+    # Stats a handful of files, cheap enough to do for every query. If any of
+    # them changed, all cached results are stale.
+    cache.validate(data_fingerprint(params))
+    key = design_key(method, code, params, max_variation, blind_search)
+    hit = cache.get(key)
+    if hit:
+        print(log('Found query in cache'))
+        return hit
+
     if method == 'sanger':
 
         # This would otherwise fail later on HGVS parsing error
         if len(code) > 1:
             raise ValueError('Wrong query syntax, should be something like "NM_000546.6:c.215C>G"')
         
-        try:
-            v = Variant(code[0], hdp, params['version'])
-        # TODO: Catch this error in the main fn so we don't have st.x() fn
-        # all over the code? We could let all errors propagate up to there ...
-        except hgvs.exceptions.HGVSParseError:
-            st.warning('Variant could not be parsed, check syntax (spaces?).')
-            st.stop()
+        # A malformed variant raises HGVSParseError; the app warns about it
+        # in main(), a batch logs it and moves on (see design_batch()).
+        v = Variant(code[0], hdp, params['version'])
 
     elif method == 'qpcr':
         if len(code) != 2:
@@ -80,65 +88,44 @@ def gimme_some_primers(method, code, fp_genome, genome, hdp, db, vardbs, params,
     tmp.load_variation_freqs_(vardbs, params)
     tmp.load_variation_(max_variation)
     tmp.get_sequence_(genome)
+    # Don't let primer3 put primers into repeats (see primer4/kmers.py)
+    if params.get('mappability', {}).get('path'):
+        tmp.load_mappability_(load_mappability(params['mappability']['path']))
+
+    # Mask and get primers. The design passes are independent of each other,
+    # so we collect them as jobs first; their primers are then streamed into
+    # the specificity check (see primer4/pipeline.py), which stops the design
+    # once enough pairs pass.
+    pool = design_pool(params['design']['n_workers'])
+    offset = 0
 
-    # Mask and get primers
     if method == 'sanger':
         
         constraints = tmp.apply(method, db, params)
-        masked = mask_sequence(tmp.sequence, tmp.mask)
+        masked = tmp.masked_sequence()
         
         # We can run primer4 in two ways: First mark SNVs, then search primers
         # "between" them OR first search primers, and then filter them if any
         # SNVs are located in sensitive areas such as 3' binding sites.
-        print(log('Run: SNVs first'))
         constraints['snvs'] = tmp.mask
-        primers = [p for p in next(
-            design_primers(masked, constraints, params, []))]
-        del masked
-        del constraints
-        #gc.collect()
-        print(log(f'Found {len(primers)} primers'))
-        #print(constraints)
-        
+        jobs = [(masked, constraints)]
         if blind_search:
-            nomask = mask_sequence(tmp.sequence, set())
-            #constraints['snvs'] = tmp.mask
-            #import pdb
-            #pdb.set_trace()
-            print(log('Run: Design first'))
-            primers_nomask = [p for p in next(
-                design_primers(nomask, constraints, params, []))]
-            # print(constraints)
-            print(log(f'Found {len(primers_nomask)} more primers'))
-            primers = primers + primers_nomask
-            print(log(f'Found {len(primers)} in total'))
+            nomask = tmp.masked_sequence(snvs=False)
+            jobs.append((nomask, constraints))
 
 
     elif method == 'qpcr':
-        masked = mask_sequence(tmp.sequence, tmp.mask)
+        masked = tmp.masked_sequence()
         
-        print(log('Run: SNVs first'))
-        primers = []
         all_constraints = tmp.apply('qpcr', db, params)
+        jobs = []
         for constraints in all_constraints:
-            # print(constraints)
             constraints['snvs'] = tmp.mask
-            x = [p for p in next(design_primers(masked, constraints, params, []))]
-            primers.extend(x)
-        print(log(f'Found {len(primers)}'))
+            jobs.append((masked, constraints))
 
         if blind_search:
-            nomask = mask_sequence(tmp.sequence, set())
-            #constraints['snvs'] = tmp.mask
-            #import pdb
-            #pdb.set_trace()
-            print(log('Run: Design first'))
-            
-            for constraints in all_constraints:
-                primers_nomask = [p for p in next(
-                    design_primers(nomask, constraints, params, []))]
-                primers.extend(primers_nomask)
-            print(f'Found {len(primers)} in total')
+            nomask = tmp.masked_sequence(snvs=False)
+            jobs.extend([(nomask, constraints) for constraints in all_constraints])
 
 
     elif method == 'mrna':
@@ -149,7 +136,7 @@ def gimme_some_primers(method, code, fp_genome, genome, hdp, db, vardbs, params,
         # Contains: mrna_mask, exons, offset
         
         # Mask SNVs
-        masked = mask_sequence(tmp.sequence, tmp.mask)
+        masked = tmp.masked_sequence()
         # Now merge
         mrna_mask, _, offset = tmp.mrna
         assert len(mrna_mask) == len(masked)
@@ -157,73 +144,29 @@ def gimme_some_primers(method, code, fp_genome, genome, hdp, db, vardbs, params,
 
         constraints = tmp.apply('mrna', db, params)
         constraints['snvs'] = tmp.mask
-
-        print(log('Run: SNVs first'))
-        primers = [p for p in next(design_primers(masked, constraints, params, []))]
-        # import pdb
-        # pdb.set_trace()
+        jobs = [(masked, constraints)]
 
         if blind_search:
-            nomask = mask_sequence(tmp.sequence, set())
+            nomask = tmp.masked_sequence(snvs=False)
             nomask = ''.join([j if j=='N' else i for i, j in zip(mrna_mask, nomask)])
-
-            print(log('Run: Design first'))
-            primers_nomask = [p for p in next(design_primers(nomask, constraints, params, []))]
-            # print(constraints)
-            print(log(f'Found {len(primers_nomask)} more primers'))
-            primers = primers + primers_nomask
-            print(log(f'Found {len(primers)} in total'))
-        
-        # Add offset, inplace operation
-        for p in primers:
-            p.offset = offset
+            jobs.append((nomask, constraints))
 
 
     else:
         raise ValueError('Method is not implemented, exit.')
     
-    
-    if blind_search:
-        primers = dereplicate(primers)
-        print(log(f'Dereplicated primers from two search cycles (with and without SNVs): {len(primers)}'))
-
-    mx_cand = params['primers']['check_max_num_candidates']
+    print(log(f'Run: SNVs first{", Design first" if blind_search else ""}'))
+    # Pairs found in both passes of the blind search are only checked once
+    all_results, all_aln, seen = check_streamed(
+        pool.iter(jobs, params), fp_genome, params, cache=cache)
+    del jobs
     mx = params['n_return']
-    
-    # import pdb; pdb.set_trace()
-    from collections import deque
-    primers_copy = deque(sort_by_penalty(primers))
 
-    seen = 0
-    all_results, all_aln = [], []
-    batch_size = 10
-    
-    while True:
-        batch = []
-        for i in range(batch_size):
-            try:
-                left = primers_copy.popleft()
-                batch.append(left)
-            except IndexError:
-                # IndexError: pop from an empty deque
-                pass
-        
-        if batch:
-            # Can be empty if number of primers %% 10 == 0
-            results, aln = check_for_multiple_amplicons(batch, fp_genome, params)
-            all_results += results
-            all_aln += aln
-            seen += len(batch)
-        else:
-            break
+    if offset:
+        # Add offset, inplace operation
+        for p in all_results:
+            p.offset = offset
 
-        if len(all_results) >= mx:
-            break
-        elif seen >= mx_cand:
-            break
-        else:
-            continue
-        
     # Until now, we have only checked the alignment of primers to the
     # reference genome -- any "variants" are really mapping mismatches.
     # In the case of designing primers while ignoring SNVs, we need to
@@ -241,12 +184,88 @@ def gimme_some_primers(method, code, fp_genome, genome, hdp, db, vardbs, params,
     msg = f'{len(all_results)}/{seen} primer pairs pass all filters'
     print(log(msg))
     st.write(msg)
-    # Results are sorted so we can just return the top mx elements.
+    # Results are checked best first (by penalty within each batch), so we
+    # can just return the top mx elements.
     
-    del primers
-    del primers_copy
     #gc.collect()
-    return all_results[:mx], tmp, all_aln[:mx]
+    result = (all_results[:mx], tmp, all_aln[:mx])
+    try:
+        cache.set(key, result)
+    except (pickle.PicklingError, TypeError, AttributeError) as e:
+        # Not worth failing the query over
+        print(log(f'Could not cache result: {e}'))
+    return result
+
+def design_batch(queries, params, max_variation=0., blind_search=False):
+    '''
+    Design primers for many queries in one process. The reference genome,
+    annotation, transcript mappings and variant files are opened once and
+    shared by all queries; results are streamed out as soon as a query is
+    done.
+
+    queries = [
+        ('sanger', 'NM_000546.6:c.215C>G'),
+        ('qpcr', 'NM_000546.6::4'),
+        ('mrna', 'NM_000546.6::5::7'),
+        ]
+    for query, primers, tmp, aln in design_batch(queries, credentials.params):
+        ...
+
+    The "PCR" method in input.csv (as used by the workflow) means "sanger".
+    Queries that fail (eg HGVS syntax) are logged and return no primers, so
+    one typo does not end a batch of hundreds.
+    '''
+    if 'cn' not in params:
+        params.update({'cn': load_chromosome_names(params['data']['chrom_names'])})
+
+    x = params['data']['sequences']
+    if Path(x).exists():
+        os.environ['HGVS_SEQREPO_DIR'] = x
+
+    print(log('Loading reference genome, annotation and variants'))
+    fp_genome = params['data']['reference']
+    genome = Fasta(fp_genome)
+    hdp = JSONDataProvider([params['data']['coordinates']])
+    db = gffutils.FeatureDB(params['data']['annotation'], keep_order=True)
+    vardbs = {k: VariantFile(v) for k, v in params['data']['variation'].items()}
+
+    aliases = {'pcr': 'sanger'}
+    # The consumer might not read to the end (or raise), close the files anyway
+    try:
+        for method, query in queries:
+            method = aliases.get(method.lower(), method.lower())
+            code = query.strip().split('::')
+            print(log(f'Query: {query} ({method})'))
+
+            try:
+                tx = code[0].split(':')[0]
+                used_tx = sync_tx_with_feature_db(tx, db)
+                if used_tx != tx:
+                    print(log(f'Used trancript {used_tx}'))
+                    code = [code[0].replace(tx, used_tx)] + code[1:]
+
+                primers, tmp, aln = gimme_some_primers(
+                    method,
+                    code,
+                    fp_genome,
+                    genome,
+                    hdp,
+                    db,
+                    vardbs,
+                    params,
+                    max_variation,
+                    blind_search)
+
+            except Exception as e:
+                print(log(f'Failed: {query} ({e.__class__.__name__}: {e})'))
+                yield query, [], None, []
+                continue
+
+            yield query, primers, tmp, aln
+    finally:
+        for v in vardbs.values():
+            v.close()
+
 
 @st.cache
 def load_chromosome_names(fn):
@@ -262,6 +281,20 @@ def load_chromosome_names(fn):
 
 # https://docs.streamlit.io/knowledge-base/using-streamlit/caching-issues
 # https://discuss.streamlit.io/t/unhashabletype-cannot-hash-object-of-type-thread-local/1917
+@st.cache(allow_output_mutation=True)
+def design_pool(n_workers):
+    # Same as the reference genome etc., we want one pool for all sessions
+    # and keep its worker processes warm between queries.
+    print(log(f'Set up design pool ({n_workers} workers)'))
+    return DesignPool(n_workers)
+
+
+@st.cache(allow_output_mutation=True)
+def result_cache(fp, max_size_mb):
+    print(log(f'Open result cache {fp}'))
+    return DiskCache(fp, max_size_mb * 2**20)
+
+
 @st.cache(allow_output_mutation=True)
 def housekeeping(params):
     print(log('Housekeeping ...'))
@@ -430,17 +463,21 @@ def main():
                 print(log('Primer design'))
 
                 with st.spinner(text='Design in progress ...'):
-                    primers, tmp, aln = gimme_some_primers(
-                        method,
-                        code,
-                        params['data']['reference'],
-                        genome,
-                        hdp,
-                        db,
-                        vardbs,
-                        params,
-                        max_variation,
-                        blind_search)
+                    try:
+                        primers, tmp, aln = gimme_some_primers(
+                            method,
+                            code,
+                            params['data']['reference'],
+                            genome,
+                            hdp,
+                            db,
+                            vardbs,
+                            params,
+                            max_variation,
+                            blind_search)
+                    except hgvs.exceptions.HGVSParseError:
+                        st.warning('Variant could not be parsed, check syntax (spaces?).')
+                        st.stop()
                 del genome
                 del hdp
                 del vardbs
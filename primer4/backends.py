@@ -0,0 +1,250 @@
+'''
+Engines for the specificity check: blastn (default), isPcr and our own
+index. All implement Backend (see primer4/design.py), so
+check_for_multiple_amplicons() pairs and filters their results the same way.
+
+Pick one in the settings:
+
+"specificity": {"backend": "blast"}  # or "ispcr", "index"
+
+search = get_backend(params, cache)
+results, aln = check_for_multiple_amplicons(primers, fp_genome, params, search)
+
+A new engine subclasses Backend and goes into BACKENDS. If it finds sites of
+single oligos, oligo_sites() is all it needs (see IndexBackend); if it
+reports products of pairs, it implements amplicons() and sites() (see
+IsPcrBackend).
+'''
+from collections import defaultdict, namedtuple
+from concurrent.futures import CancelledError
+import re
+import subprocess
+from threading import Thread
+
+import pandas as pd
+
+from primer4.cache import ispcr_key
+from primer4.design import Backend, BlastSearch, watch
+from primer4.index import count_amplicons, load_index
+from primer4.utils import log
+
+
+class IndexBackend(Backend):
+    '''
+    In-silico PCR against our own index of the genome, see primer4/index.py.
+    Sites are searched per oligo when first asked for; the index is fast
+    enough that we don't cache them on disk.
+    '''
+    def __init__(self, params, cache=None, index=None):
+        super().__init__(params, cache)
+        self.index = index or load_index(params['index']['path'])
+        self.found = {}  # oligo: ((left, strand, length), sites)
+
+    def __repr__(self):
+        return f'IndexBackend({self.index}, {len(self.found)} oligos)'
+
+    def search(self, oligo):
+        if oligo not in self.found:
+            left, strand, profiles = self.index.search(
+                oligo,
+                self.params['primers']['mn_3prime_matches'],
+                self.params['index']['mx_mismatches'])
+            # Repetitive primers are counted exactly (see amplicons()), but we
+            # don't need the alignment of each of their sites.
+            mx = self.params['blast']['mx_blast_hits']
+            sites = pd.DataFrame(
+                self.index.locate(left[:mx], strand[:mx], profiles[:mx], len(oligo)),
+                columns=['sseqid', 'sstart', 'send', 'sstrand', 'aln'])
+            self.found[oligo] = ((left, strand, len(oligo)), sites)
+            self.runs += 1
+        return self.found[oligo]
+
+    def oligo_sites(self, oligo):
+        return self.search(oligo)[1]
+
+    def amplicons(self, primer, stop=None):
+        mx_amplicon_len = self.params['primers']['mx_amplicon_len']
+        fwd, _ = self.search(primer.fwd.sequence)
+        rev, _ = self.search(primer.rev.sequence)
+        # fwd on plus and rev on minus, or the other way round
+        starts = self.index.starts
+        n = count_amplicons(fwd, rev, mx_amplicon_len, starts)
+        if (stop is None) or (n <= stop):
+            n += count_amplicons(rev, fwd, mx_amplicon_len, starts)
+        return n
+
+
+# A product reported by isPcr, 1-based coordinates on the plus strand; on the
+# minus strand (strand "-"), the fwd primer binds at the end
+Product = namedtuple('Product', 'contig start end strand sequence')
+
+
+class IsPcrBackend(Backend):
+    '''
+    In-silico PCR with isPcr from UCSC, like the "pcr" process of the Nextflow
+    workflow (workflow/processes.nf):
+
+    "ispcr": {"index": "/mnt/data/redux.2bit"}  # or the FASTA
+
+    isPcr searches pairs, not single oligos, and reports their products, so
+    we keep (and cache) the products per pair.
+
+    - https://genome.ucsc.edu/cgi-bin/hgPcr
+    - https://hgdownload.soe.ucsc.edu/admin/exe/
+    '''
+    def __init__(self, params, cache=None):
+        super().__init__(params, cache)
+        self.pairs = {}  # (fwd, rev): products
+        self.runs = 0
+        self.cached = 0
+
+    def __repr__(self):
+        return f'IsPcrBackend({len(self.pairs)} pairs, {self.runs} isPcr runs, {self.cached} from cache)'
+
+    def key(self, pair):
+        return ispcr_key(pair, self.params)
+
+    def prefetch(self, primers):
+        missing = set(
+            (p.fwd.sequence, p.rev.sequence) for p in primers) - set(self.pairs)
+
+        if self.cache is not None:
+            for pair in list(missing):
+                products = self.cache.get(self.key(pair))
+                if products is not None:
+                    self.pairs[pair] = products
+                    missing.remove(pair)
+                    self.cached += 1
+        if not missing:
+            return None
+
+        queries = {f'pair{i}': pair for i, pair in enumerate(sorted(missing))}
+        found = run_ispcr(queries, self.params, self.stopped)
+        for name, pair in queries.items():
+            self.pairs[pair] = found.get(name, [])
+            if self.cache is not None:
+                self.cache.set(self.key(pair), self.pairs[pair])
+        self.runs += 1
+        return None
+
+    def amplicons(self, primer, stop=None):
+        return len(self.pairs[(primer.fwd.sequence, primer.rev.sequence)])
+
+    def sites(self, primer):
+        fwd, rev = primer.fwd.sequence, primer.rev.sequence
+        lu = {}
+        for p in self.pairs[(fwd, rev)]:
+            if p.strand == '+':
+                f = (p.start, p.start + len(fwd) - 1)
+                r = (p.end - len(rev) + 1, p.end)
+            else:
+                f = (p.end - len(fwd) + 1, p.end)
+                r = (p.start, p.start + len(rev) - 1)
+            # The product reads from the fwd primer to the rev one
+            lu[(primer.name, 'fwd', p.contig, *f)] = profile(
+                fwd, p.sequence[:len(fwd)])
+            lu[(primer.name, 'rev', p.contig, *r)] = profile(
+                rev, reverse_complement(p.sequence[-len(rev):]))
+        return lu
+
+
+def run_ispcr(queries, params, stop=None):
+    '''
+    Run isPcr on the pairs (dict of name: (fwd, rev)), same settings as in
+    the workflow. Returns the products by name, see parse_ispcr().
+    '''
+    mn_matches = params['primers']['mn_3prime_matches']
+    command = [
+        'isPcr',
+        params['ispcr']['index'],
+        'stdin',
+        'stdout',
+        f'-maxSize={params["primers"]["mx_amplicon_len"]}',
+        f'-minPerfect={mn_matches}',
+        f'-minGood={mn_matches}',
+        '-out=fa',
+        ]
+    query = ''.join(f'{k}\t{f}\t{r}\n' for k, (f, r) in queries.items())
+    print(log(f'Search products of {len(queries)} pair(s) (isPcr)'))
+
+    proc = subprocess.Popen(
+        command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE, text=True)
+    if stop is not None:
+        Thread(target=watch, args=(proc, stop), daemon=True).start()
+    out, err = proc.communicate(query)
+
+    if proc.returncode and (stop is not None) and stop.is_set():
+        raise CancelledError()
+    elif proc.returncode:
+        raise subprocess.CalledProcessError(
+            proc.returncode, command, output=out, stderr=err)
+    return parse_ispcr(out)
+
+
+def parse_ispcr(s):
+    '''
+    Products from the FASTA output of isPcr (-out=fa), by pair name:
+
+    >NC_000017.11:7675941+7676201 pair0 261bp ACGTCTGAAAATGACCCTCACT TTGAGCAACCGCAGAC
+    ACGTCTGAAAATGACCCTCACTatcatagccagaa...
+
+    Same header as parsed in workflow/bin/pseudo.py, but we also read the
+    strand (the + or - between start and end) and the sequence.
+    '''
+    header = re.compile(r'^>(.+):(\d+)([+-])(\d+) (\S+) \d+bp \S+ \S+')
+    products = defaultdict(list)
+
+    def add(name, x, seq):
+        contig, start, strand, end = x
+        products[name].append(
+            Product(contig, int(start), int(end), strand, ''.join(seq)))
+
+    current = None
+    for line in s.splitlines():
+        if line.startswith('>'):
+            if current:
+                add(*current)
+            m = header.match(line)
+            if not m:
+                raise ValueError(f'Unexpected isPcr output: {line}')
+            *x, name = m.groups()
+            current = (name, x, [])
+        elif current and line.strip():
+            current[2].append(line.strip())
+    if current:
+        add(*current)
+    return dict(products)
+
+
+def profile(primer, site):
+    '''
+    Alignment profile of a primer and the genome where it binds, like
+    parse_blast_btop() in design: "." match, "|" mismatch.
+    '''
+    return ''.join(
+        '.' if a == b else '|' for a, b in zip(primer.upper(), site.upper()))
+
+
+def reverse_complement(seq):
+    return seq[::-1].upper().translate(str.maketrans('ACGTN', 'TGCAN'))
+
+
+BACKENDS = {
+    'blast': BlastSearch,
+    'ispcr': IsPcrBackend,
+    'index': IndexBackend,
+    }
+
+
+def get_backend(params, cache=None):
+    '''
+    The engine for the specificity check, from the settings. Without a choice
+    there, we use our own index if there is one, otherwise blastn.
+    '''
+    default = 'index' if params.get('index', {}).get('path') else 'blast'
+    name = params.get('specificity', {}).get('backend', default)
+    if name not in BACKENDS:
+        raise ValueError(
+            f'Unknown specificity backend "{name}", pick one of: {", ".join(BACKENDS)}')
+    return BACKENDS[name](params, cache)
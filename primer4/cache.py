@@ -0,0 +1,239 @@
+'''
+Users query the same variants over and over (re-orders, colleagues double
+checking, browser refreshes), so we keep results on disk.
+
+cache = DiskCache('cache.sqlite', max_size=500 * 2**20)
+cache.validate(data_fingerprint(params))
+key = design_key('sanger', ['NM_000546.6:c.215C>G'], params, 0.01, False)
+cache.get(key)
+# None
+cache.set(key, (primers, tmp, aln))
+
+The BLAST hits of single oligos go into the same cache, see oligo_key().
+'''
+from glob import glob
+import hashlib
+import json
+import os
+import pickle
+import sqlite3
+from threading import Lock
+import time
+
+
+class DiskCache():
+    '''
+    Key-value store on disk (SQLite, like the annotation) which holds at most
+    <max_size> bytes of pickled values; the least recently used entries are
+    evicted first.
+
+    All entries belong to a namespace, usually a fingerprint of the data they
+    were derived from. When the namespace changes, the entries are dropped
+    (see validate()).
+    '''
+    def __init__(self, fp, max_size):
+        self.fp = fp
+        self.max_size = max_size
+        # Streamlit serves each session from its own thread
+        self.lock = Lock()
+        self.db = sqlite3.connect(fp, timeout=30, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS cache '
+                '(key TEXT PRIMARY KEY, value BLOB, size INTEGER, atime REAL)')
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+            # Bytes stored, kept up to date on every insert and delete, so
+            # set() does not have to add up the whole table (see evict())
+            self.total = self.db.execute(
+                'SELECT COALESCE(SUM(size), 0) FROM cache').fetchone()[0]
+
+    def __repr__(self):
+        return f'DiskCache({self.fp}, {len(self)} entries, {self.size()} bytes)'
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+
+    def size(self):
+        with self.lock:
+            return self.db.execute(
+                'SELECT COALESCE(SUM(size), 0) FROM cache').fetchone()[0]
+
+    def validate(self, namespace):
+        '''
+        Drop all entries if they were stored under a different namespace.
+        '''
+        with self.lock, self.db:
+            row = self.db.execute(
+                'SELECT value FROM meta WHERE key = ?', ('namespace',)).fetchone()
+            if row and row[0] == namespace:
+                return True
+            self.db.execute('DELETE FROM cache')
+            self.total = 0
+            self.db.execute(
+                'INSERT OR REPLACE INTO meta VALUES (?, ?)', ('namespace', namespace))
+            return False
+
+    def get(self, key):
+        with self.lock, self.db:
+            row = self.db.execute(
+                'SELECT value FROM cache WHERE key = ?', (key,)).fetchone()
+            if not row:
+                return None
+            self.db.execute(
+                'UPDATE cache SET atime = ? WHERE key = ?', (time.time(), key))
+        try:
+            return pickle.loads(row[0])
+        except (pickle.UnpicklingError, AttributeError, TypeError, ImportError):
+            # Stored by an older version of our classes, eg before PrimerPair
+            # got slots; treat as a miss.
+            with self.lock, self.db:
+                self.delete(key)
+            return None
+
+    def set(self, key, value):
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(blob) > self.max_size:
+            return None
+
+        with self.lock, self.db:
+            # Replacing an entry frees its old size
+            self.delete(key)
+            self.db.execute(
+                'INSERT INTO cache VALUES (?, ?, ?, ?)',
+                (key, blob, len(blob), time.time()))
+            self.total += len(blob)
+            self.evict()
+        return None
+
+    def delete(self, key):
+        # Caller holds the lock
+        row = self.db.execute(
+            'SELECT size FROM cache WHERE key = ?', (key,)).fetchone()
+        if row:
+            self.db.execute('DELETE FROM cache WHERE key = ?', (key,))
+            self.total -= row[0]
+        return None
+
+    def evict(self):
+        # Caller holds the lock
+        if self.total <= self.max_size:
+            return None
+
+        drop = []
+        for key, size in self.db.execute(
+            'SELECT key, size FROM cache ORDER BY atime'):
+            drop.append((key,))
+            self.total -= size
+            if self.total <= self.max_size:
+                break
+        self.db.executemany('DELETE FROM cache WHERE key = ?', drop)
+        return None
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def data_fingerprint(params):
+    '''
+    Digest of the reference, annotation, variant and BLAST files the results
+    depend on. Hashing gigabytes of genome would take longer than the design
+    itself, so we use path, size and modification time as a proxy.
+    '''
+    paths = []
+
+    def collect(x):
+        if isinstance(x, dict):
+            for v in x.values():
+                collect(v)
+        elif isinstance(x, str):
+            paths.append(x)
+
+    collect(params['data'])
+    # A BLAST database is a bunch of files sharing a prefix (.nsq, .nin, ...)
+    paths.extend(glob(f'{params["blast"]["index"]}*'))
+    shards = params['blast'].get('shards')
+    if shards and os.path.exists(shards):
+        paths.append(shards)
+        with open(shards, 'r') as file:
+            for i in json.load(file)['shards']:
+                paths.extend(glob(f'{os.path.join(os.path.dirname(shards), i["index"])}*'))
+    if params.get('ispcr', {}).get('index'):
+        paths.append(params['ispcr']['index'])
+    if params.get('index', {}).get('path'):
+        paths.extend(glob(f'{params["index"]["path"]}/*'))
+    if params.get('kmers', {}).get('path'):
+        paths.append(params['kmers']['path'])
+    if params.get('mappability', {}).get('path'):
+        paths.extend(glob(f'{params["mappability"]["path"]}/*'))
+
+    h = hashlib.sha256()
+    for fp in sorted(set(paths)):
+        try:
+            s = os.stat(fp)
+            h.update(f'{fp}:{s.st_size}:{s.st_mtime_ns}\n'.encode())
+        except FileNotFoundError:
+            h.update(f'{fp}:missing\n'.encode())
+    return h.hexdigest()
+
+
+def design_key(method, code, params, max_variation, blind_search):
+    '''
+    Cache key for a query. Only settings that change the result go in; the
+    data files are covered by data_fingerprint(), and eg the number of CPUs
+    does not matter.
+    '''
+    ignore = {
+        'data', 'cn', 'cache', 'design',
+        # not relevant for the result, only for how fast we get there
+        'n_cpus',
+        }
+
+    def relevant(d):
+        return {
+            k: relevant(v) if isinstance(v, dict) else v
+            for k, v in d.items() if k not in ignore}
+
+    query = '::'.join(str(i).strip() for i in code)
+    x = json.dumps(
+        [method.lower(), query, relevant(params), max_variation, blind_search],
+        sort_keys=True,
+        default=str)
+    return hashlib.sha256(x.encode()).hexdigest()
+
+
+def oligo_key(oligo, params):
+    '''
+    Cache key for the (filtered) BLAST hits of an oligo, see BlastSearch in
+    design. The index files are covered by data_fingerprint().
+    '''
+    x = json.dumps([
+        'hits',
+        oligo.upper(),
+        params['blast']['word_size'],
+        params['blast']['mx_evalue'],
+        params['blast']['index'],
+        params['blast'].get('shards'),
+        params['primers']['mn_3prime_matches'],
+        ])
+    return hashlib.sha256(x.encode()).hexdigest()
+
+
+def ispcr_key(pair, params):
+    '''
+    Cache key for the isPcr products of a pair (fwd, rev), see IsPcrBackend
+    in backends. Same settings as on the isPcr command line; the index file
+    is covered by data_fingerprint().
+    '''
+    fwd, rev = pair
+    x = json.dumps([
+        'ispcr',
+        fwd.upper(),
+        rev.upper(),
+        params['ispcr']['index'],
+        params['primers']['mx_amplicon_len'],
+        params['primers']['mn_3prime_matches'],
+        ])
+    return hashlib.sha256(x.encode()).hexdigest()
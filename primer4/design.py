@@ -1,23 +1,35 @@
 from collections import defaultdict
-from itertools import chain, product
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+from functools import lru_cache
+from itertools import chain
+import json
 from pathlib import Path
+from queue import Queue
 import re
 import subprocess
-import tempfile
-
-import gc
+from tempfile import TemporaryFile
+from threading import Event, Lock, Thread
 
 import numpy as np
 import pandas as pd
 import primer3
 from tqdm import tqdm
 
-from primer4.models import PrimerPair
+from primer4.cache import oligo_key
+from primer4.models import PrimerPair, PrimerTable
+from primer4.space import Window
 from primer4.utils import log
 
 
-def design_primers(masked, constraints, params, previous=[]):
+def stream_primers(masked, constraints, params, mx_pairs=100):
     '''
+    Design up to <mx_pairs> primer pairs on the masked template and hand
+    them out as soon as they are selected, so the caller can start checking
+    them (see primer4/pipeline.py) and stop asking once it has enough.
+
+    for p in stream_primers(masked, constraints, params):
+        ...
+
     # 'SEQUENCE_EXCLUDED_REGION'
     # https://primer3.org/manual.html#SEQUENCE_EXCLUDED_REGION
     
@@ -31,10 +43,187 @@ def design_primers(masked, constraints, params, previous=[]):
     - https://primer3.org/manual.html#PRIMER_EXPLAIN_FLAG
     - https://primer3.ut.ee/primer3web_help.htm#PRIMER_MAX_NS_ACCEPTED
 
-    Note that the recursive way we implement this here is greedy, i.e. we take
-    the best, then mask, then take the next best, ie no "global optimization".
+    Note that the way we implement this here is greedy, i.e. we take the best,
+    then mask, then take the next best, ie no "global optimization".
+
+    We used to call primer3 once per accepted pair, masking the pair (or the
+    offending SNVs) and recursing. Masking only ever removes candidates, so
+    instead we ask primer3 for a pool of candidates in one go and replay the
+    greedy selection on it (see select_pairs()). primer3 is only called again
+    when the next pair is requested and the current pool is used up.
+    '''
+    n = mx_pairs
+    found = 0
+
+    # primer3 only gets to see the part of the template where the amplicon
+    # can be, see Window; we translate the primers back at the end.
+    window = Window(constraints, len(masked))
+    constraints = window.constrain(constraints)
+    if any(length == 0 for _, length in constraints['only_here']):
+        # No room for primers
+        return
+
+    # We keep the template as a mutable byte array and mask it inplace; the
+    # string primer3 needs is only built once per round.
+    template = bytearray(window.crop(masked), 'ascii')
+
+    while found < mx_pairs:
+        # The pool gets the more expensive the more pairs we ask for; if the
+        # last one broke off early, the next will likely, too.
+        n = min(n, mx_pairs - found)
+        candidates = design_candidates(
+            template.decode(), constraints, params, n, mx_pairs)
+        if not candidates:
+            # No primers found
+            break
+
+        selected, complete, n_masked = select_pairs(
+            candidates,
+            template,
+            constraints.get('snvs'),
+            mx_ns=params['Ns_max'],
+            mn_3prime_matches=params['primers']['mn_3prime_matches'])
+        for p in selected:
+            yield shift_pair(p, window.start)
+        found += len(selected)
+
+        if complete and len(candidates) < n:
+            # primer3 has nothing left for us
+            break
+        if not (selected or n_masked):
+            # Masking did not change the template, primer3 would return the
+            # same pool again.
+            break
+        n = 2 * (len(selected) + 1)
+
+
+def shift_pair(pair, offset):
+    '''
+    Move a primer pair by <offset> positions, eg from window to template
+    coordinates.
+    '''
+    d = dict(pair.data)
+    for x in ['fwd', 'rev']:
+        d[x] = dict(
+            d[x], start=d[x]['start'] + offset, end=d[x]['end'] + offset)
+    return PrimerPair(d)
+
+
+# primer3 global settings and where we take them from in params
+GLOBAL_ARGS = {
+    'PRIMER_MIN_SIZE': 'size_min',
+    'PRIMER_OPT_SIZE': 'size_opt',
+    'PRIMER_MAX_SIZE': 'size_max',
+
+    'PRIMER_MAX_NS_ACCEPTED': 'Ns_max',
+
+    'PRIMER_MIN_TM': 'tm_min',
+    'PRIMER_OPT_TM': 'tm_opt',
+    'PRIMER_MAX_TM': 'tm_max',
+    'PRIMER_MIN_GC': 'GC_min',
+    'PRIMER_MAX_GC': 'GC_max',
+
+    'PRIMER_MAX_POLY_X': 'homopolymer_max_len',
+    'PRIMER_MAX_END_GC': '3prime_max_GC',
+    'PRIMER_MAX_END_STABILITY': '3prime_stability',
+
+    # Any two left (right) primers in the pool have their 3' ends at
+    # least this far apart; closer ones overlap, see select_pairs().
+    'PRIMER_MIN_LEFT_THREE_PRIME_DISTANCE': 'size_min',
+    'PRIMER_MIN_RIGHT_THREE_PRIME_DISTANCE': 'size_min',
+
+    # defaults, here to be explicit
+    'PRIMER_SALT_MONOVALENT': 'salt_monovalent',
+    'PRIMER_SALT_DIVALENT': 'salt_divalent',
+    'PRIMER_DNTP_CONC': 'conc_dNTP',
+    'PRIMER_DNA_CONC': 'conc_DNA',
+}
+
+
+class DesignSession():
+    '''
+    primer3 keeps its global settings (everything but the SEQUENCE_* args) in
+    the process. Instead of rebuilding and resending them for every template,
+    a session checks them once and only installs them when they differ from
+    what primer3 currently has; after that, a design call only sends the
+    sequence args.
+
+    session = design_session(params)
+    designs = session.run(
+        {'SEQUENCE_TEMPLATE': masked},
+        {'PRIMER_NUM_RETURN': 100, 'PRIMER_PRODUCT_SIZE_RANGE': [[350, 600]]})
+
+    Sessions with different params (eg two users with different Tm ranges)
+    share the same primer3, so installing the globals and running the design
+    happens under one lock.
+
+    https://libnano.github.io/primer3-py/quickstart.html#workflow
+    '''
+    lock = Lock()
+    installed = None  # key of the globals primer3 has right now
+
+    # primer3-py 0.6.x keeps the globals when called without them; from
+    # version 1 on they are required (and reset) on every call.
+    keeps_globals = getattr(primer3, '__version__', '0').split('.')[0] == '0'
+
+    def __init__(self, params):
+        self.globals = {k: params[v] for k, v in GLOBAL_ARGS.items()}
+        self.validate()
+        self.compiled = {}
+
+    def __repr__(self):
+        return f'DesignSession({len(self.compiled)} setting(s) compiled)'
+
+    def validate(self):
+        g = self.globals
+        for x in ['SIZE', 'TM']:
+            lo, opt, hi = [g[f'PRIMER_{i}_{x}'] for i in ['MIN', 'OPT', 'MAX']]
+            if not lo <= opt <= hi:
+                raise ValueError(f'Primer {x.lower()} must be min <= opt <= max, got {lo}, {opt}, {hi}')
+        if not g['PRIMER_MIN_GC'] <= g['PRIMER_MAX_GC']:
+            raise ValueError('Primer GC must be min <= max')
+        return None
+
+    def run(self, seq_args, extra):
+        '''
+        <extra> are the global args that change from template to template,
+        eg the amplicon size range. Keep values that change with every call
+        out of them, or the globals are reinstalled every time.
+        '''
+        key = (id(self), repr(sorted(extra.items())))
+        global_args = self.compiled.get(key)
+        if not global_args:
+            global_args = self.compiled[key] = {**self.globals, **extra}
+
+        with self.lock:
+            if (DesignSession.installed == key) and self.keeps_globals:
+                return primer3.bindings.designPrimers(seq_args)
+            DesignSession.installed = key
+            return primer3.bindings.designPrimers(seq_args, global_args)
+
+
+sessions = {}
+
+
+def design_session(params):
+    '''
+    One DesignSession per set of design params, eg per user settings.
+    '''
+    key = tuple(params[v] for v in GLOBAL_ARGS.values())
+    if key not in sessions:
+        sessions[key] = DesignSession(params)
+    return sessions[key]
+
+
+def design_candidates(masked, constraints, params, n, mx_pairs=100):
+    '''
+    Run primer3 once and return up to <n> candidate pairs, best first.
+
+    primer3 is always asked for <mx_pairs>, not <n>: the number changes from
+    round to round (see stream_primers()), and as a global arg it would
+    otherwise have the session reinstall all globals every time. We take the
+    first <n> of what comes back.
     '''
-    # print('Another round!')
     size_range = constraints['size_range']
 
     # https://primer3.ut.ee/primer3web_help.htm
@@ -42,89 +231,76 @@ def design_primers(masked, constraints, params, previous=[]):
     # <left_start>,<left_length>,<right_start>,<right_length>
     # SEQUENCE_PRIMER_PAIR_OK_REGION_LIST=100,50,300,50 ; 900,60,, ; ,,930,100
     only_here = list(chain(*constraints['only_here']))
-    # print(only_here)
-    # pdb.set_trace()
-
-    # Mask the position of the primer pair from the previous cycle
-    if previous:
-        x = previous[-1]
-        start, end = x.fwd.start, x.fwd.end
-        mask_fwd = masked[:start] + ('N' * (end - start)) + masked[end:]
 
-        start, end = x.rev.start, x.rev.end
-        mask_rev = masked[:start] + ('N' * (end - start)) + masked[end:]
-
-        masked = ''.join(
-            [i if i==j else 'N' for i, j in zip(mask_fwd, mask_rev)])
-
-    #print(only_here)
-    spec =  [
+    designs = design_session(params).run(
         {
             'SEQUENCE_TEMPLATE': masked,
             'SEQUENCE_PRIMER_PAIR_OK_REGION_LIST': only_here,
         },
         {
-            'PRIMER_NUM_RETURN': params['n_return'],
-            'PRIMER_MIN_SIZE': params['size_min'],
-            'PRIMER_OPT_SIZE': params['size_opt'],
-            'PRIMER_MAX_SIZE': params['size_max'],
-
-            'PRIMER_MAX_NS_ACCEPTED': params['Ns_max'],
-    
-            'PRIMER_MIN_TM': params['tm_min'],
-            'PRIMER_OPT_TM': params['tm_opt'],
-            'PRIMER_MAX_TM': params['tm_max'],
-            'PRIMER_MIN_GC': params['GC_min'],
-            'PRIMER_MAX_GC': params['GC_max'],
-    
-            'PRIMER_MAX_POLY_X': params['homopolymer_max_len'],
-            'PRIMER_MAX_END_GC': params['3prime_max_GC'],
-            'PRIMER_MAX_END_STABILITY': params['3prime_stability'],
-            'PRIMER_MAX_NS_ACCEPTED': params['Ns_max'],
-            
+            'PRIMER_NUM_RETURN': mx_pairs,
             'PRIMER_PRODUCT_SIZE_RANGE': [size_range],
-    
-            # defaults, here to be explicit
-            'PRIMER_SALT_MONOVALENT': params['salt_monovalent'],
-            'PRIMER_SALT_DIVALENT': params['salt_divalent'],
-            'PRIMER_DNTP_CONC': params['conc_dNTP'],
-            'PRIMER_DNA_CONC': params['conc_DNA'],
-        }
-    ]
+        })
+    n_found = min(designs.get('PRIMER_PAIR_NUM_RETURNED', 0), n)
+    return [PrimerPair(v) for k, v in sorted(parse_designs(designs, n_found).items())]
 
-    # https://libnano.github.io/primer3-py/quickstart.html#workflow
-    designs = primer3.bindings.designPrimers(*spec)
-    
-    try:
-        best = PrimerPair(parse_designs(designs, n=1)[0])
-        #print(best)
-        #from collections import Counter
-        #print('Ns:', Counter(masked)['N'])
-
-        if not constraints.get('snvs'):
-            raise ValueError('No constraints')
-
-        d = project_mask_onto_primers(
-            best, constraints['snvs'], params['primers']['mn_3prime_matches'])
-        valid_fwd, dots_fwd, pos_fwd = d['fwd']
-        valid_rev, dots_rev, pos_rev = d['rev']
-        #print(valid_fwd, dots_fwd, pos_fwd, valid_rev, dots_rev, pos_rev)
-        
-        if not all([valid_fwd, valid_rev]):
-            # We detected an SNV in a primer.
-            masked = ''.join(
-                ['N' if ix in set(pos_fwd + pos_rev) else i for ix, i in enumerate(masked)])
-        else:
-            previous.append(best)
 
-        if len(previous)>=100:
-            yield previous
+def select_pairs(candidates, template, snvs, mx_ns=0, mn_3prime_matches=15):
+    '''
+    Replay the greedy "take the best, mask it, redesign" cycle on a pool of
+    candidates sorted by penalty:
+
+    - a candidate is out if one of its primers contains more than <mx_ns> Ns
+    on the (by now further masked) template, which is what primer3 would say
+    - a candidate w/ an SNV in its 3' end masks all SNV positions in its
+    primers (and is discarded)
+    - an accepted candidate masks its binding sites
+
+    The pool is designed such that no two candidates have 3' ends closer than
+    the minimum primer length (see design_candidates()). Pairs primer3 hid
+    this way overlap an earlier candidate, and would have been masked anyway
+    -- but only if that earlier candidate was accepted. So we stop at the
+    first candidate we do not accept, and signal whether we made it through
+    the whole pool.
+
+    <template> is the byte array the pool was designed on, and is masked
+    inplace. Returns the selected pairs, whether the pool was used up and the
+    number of positions we masked.
+    '''
+    if not snvs:
+        snvs = set()
+
+    # The SNVs don't change while we go through the pool, so we check all
+    # candidates at once.
+    valid_fwd, valid_rev = PrimerTable(candidates).snv_free(
+        snvs, mn_3prime_matches)
+
+    N = ord('N')
+    n_masked = 0
+    selected = []
+    for c, valid in zip(candidates, valid_fwd & valid_rev):
+        if any(
+            template.count(b'N', getattr(c, x).start, getattr(c, x).end) > mx_ns
+            for x in ['fwd', 'rev']):
+            return selected, False, n_masked
+
+        if not valid:
+            # We detected an SNV in a primer.
+            d = project_mask_onto_primers(c, snvs, mn_3prime_matches)
+            _, _, pos_fwd = d['fwd']
+            _, _, pos_rev = d['rev']
+            for pos in pos_fwd + pos_rev:
+                n_masked += template[pos] != N
+                template[pos] = N
+            return selected, False, n_masked
 
-        yield from design_primers(masked, constraints, params, previous)
+        selected.append(c)
+        for x in ['fwd', 'rev']:
+            start, end = getattr(c, x).start, getattr(c, x).end
+            n_masked += (end - start) - template.count(b'N', start, end)
+            template[start:end] = b'N' * (end - start)
 
-    except KeyError:
-        # No primers found
-        yield previous
+    return selected, True, n_masked
 
 
 def parse_designs(designs, n):
@@ -164,45 +340,456 @@ def sort_by_penalty(primers):
     It seems primer3 already sorts primers from best to worst, but just to
     make sure.
     '''
-    loss = {}
-    for p in primers:
-        loss[p.name] = (p.penalty, p)
-    return [v[1] for k, v in sorted(loss.items(), key=lambda x: x[1][0])]
+    # Pairs with the same key are the same pair, keep one (names are short
+    # digests, two pairs could share one)
+    unique = {p.key(): p for p in primers}
+    return PrimerTable(unique.values()).sort().primers
+
+
+# blastn tabular output (-outfmt 6)
+BLAST_FIELDS = 'qseqid sseqid qlen slen pident length mismatch gapopen qstart qend sstart send evalue bitscore nident btop sstrand'.split(' ')
+BLAST_DTYPES = {
+    'qseqid': str, 'sseqid': str, 'qlen': int, 'slen': int, 'pident': float,
+    'length': int, 'mismatch': int, 'gapopen': int, 'qstart': int,
+    'qend': int, 'sstart': int, 'send': int, 'evalue': float,
+    'bitscore': float, 'nident': int, 'btop': str, 'sstrand': str,
+    }
+BLAST_COLUMNS = {k: i for i, k in enumerate(BLAST_FIELDS)}
+MATCHES_3PRIME = re.compile(r'(\d+)$')
 
 
-def dereplicate(primers):
+def stream_blast(queries, params, stop=None, chunk_size=10000):
     '''
-    When we run two design cycles, one allowing SNVs and the other not,
-    the name primers can be found independently. Remove those duplicates.
+    Search the oligos (dict of name: sequence) against the BLAST index. The
+    query goes to blastn through stdin and the hits come back through stdout,
+    no temporary files and no shell.
+
+    blastn reports the hits of one query after the other, so we hand them out
+    the same way, as (name, hits) once a query is done, and read line by line
+    in between. Hits where the primer cannot bind (see binds_3prime()) are
+    dropped every <chunk_size> lines, column-wise; a repetitive primer with
+    tens of thousands of partial hits never sits in memory as a whole.
+    Queries without hits don't show up. Once the Event <stop> is set, blastn is killed and we raise
+    CancelledError.
+
+    for name, hits in stream_blast({'3b2def60.fwd': 'ACGT...'}, params):
+        ...
+
+    > The “Blast trace-back operations” (BTOP) string describes the alignment produced by BLAST. -- https://www.ncbi.nlm.nih.gov/books/NBK569862
+
+    Examples: 7AG39, 7A-39, 6-G-A41
     '''
-    duplicate, results = set(), []
-    for p1 in primers:
-        has_replicate = 0
-        d1 = [v for k, v in sorted(p1.data.items())]
+    fasta = ''.join(f'>{k}\n{v}\n' for k, v in queries.items())
+    mn_matches = params['primers']['mn_3prime_matches']
 
-        for p2 in primers:
-            if p1.name == p2.name:
-                continue
-            else:
-                d2 = [v for k, v in sorted(p2.data.items())]
-                if d1 == d2:
-                    duplicate.add(tuple(sorted((p1.name, p2.name))))
+    command = [
+        'blastn',
+        '-dust', 'no',
+        '-word_size', str(params['blast']['word_size']),
+        '-evalue', str(params['blast']['mx_evalue']),
+        '-outfmt', f'6 {" ".join(BLAST_FIELDS)}',
+        '-db', params['blast']['index'],
+        '-num_threads', str(params['blast']['n_cpus']),
+        ]
+    # A shard is searched as if it were the whole genome, otherwise its
+    # e-values would be computed for its own (smaller) size
+    if params['blast'].get('dbsize'):
+        command += ['-dbsize', str(params['blast']['dbsize'])]
+    print(log(f'Search alternative binding sites for {len(queries)} oligo(s)'))
+
+    def feed(stdin):
+        # blastn starts to write hits before it has read all queries, so we
+        # write from a thread; otherwise both could wait on a full pipe.
+        try:
+            stdin.write(fasta)
+            stdin.close()
+        except BrokenPipeError:
+            pass  # blastn died, we report its error below
+
+    with TemporaryFile(mode='w+') as err:
+        proc = subprocess.Popen(
+            command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=err, text=True)
+        feeder = Thread(target=feed, args=(proc.stdin,), daemon=True)
+        feeder.start()
+        if stop is not None:
+            Thread(target=watch, args=(proc, stop), daemon=True).start()
+        name, rows, kept = None, [], []
+
+        def hits():
+            # What is left of the current query's hits
+            kept.append(blast_frame(rows, mn_matches))
+            rows.clear()
+            df = pd.concat(kept, ignore_index=True) if len(kept) > 1 else kept[0]
+            kept.clear()
+            return df
 
-    # We can only get pairs of duplicates, not 3 duplicates
-    if duplicate:
-        _, not_those = zip(*duplicate)
-    else:
-        # No duplicates found
-        not_those = set()
-    for p in primers:
-        if not p.name in not_those:
-            # singletons and first in a pair of duplicates
-            results.append(p)
+        try:
+            for line in proc.stdout:
+                row = line.rstrip('\n').split('\t')
+                if row[0] != name:
+                    if name is not None:
+                        df = hits()
+                        if len(df):
+                            yield name, df
+                    name = row[0]
+                rows.append(row)
+                if len(rows) >= chunk_size:
+                    kept.append(blast_frame(rows, mn_matches))
+                    rows.clear()
+
+            # Only hand out the last query once we know blastn got through it
+            feeder.join()
+            if proc.wait() and (stop is not None) and stop.is_set():
+                raise CancelledError()
+            elif proc.returncode:
+                err.seek(0)
+                raise subprocess.CalledProcessError(
+                    proc.returncode, command, stderr=err.read())
+            if name is not None:
+                df = hits()
+                if len(df):
+                    yield name, df
+        finally:
+            # The consumer might stop early
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+            proc.stdout.close()
+
+
+def stream_shards(queries, params, stop=None):
+    '''
+    stream_blast() against all shards of the genome at once, if the BLAST
+    index is split (see scripts/prep_genome_4blast.py and the "shards"
+    manifest in the blast settings), otherwise against the one index. Each
+    shard gets its share of the <n_cpus>, and the length of the whole genome
+    (-dbsize) so its e-values are the same as against the one index.
+
+    Same as stream_blast(), each query is handed out once, with its hits
+    from all shards, as soon as every shard is done with it. blastn reports
+    the queries in the order we send them, so once a shard reports a query,
+    it is done with all before it.
+    '''
+    shards = params['blast'].get('shards')
+    if not shards:
+        yield from stream_blast(queries, params, stop)
+        return None
+
+    dbs, dbsize = load_shards(shards)
+    share = max(1, params['blast']['n_cpus'] // len(dbs))
+    stop = stop or Event()
+    found = Queue()
+
+    def run(i, db):
+        p = {**params, 'blast': {
+            **params['blast'], 'index': db, 'n_cpus': share, 'dbsize': dbsize}}
+        try:
+            for name, hits in stream_blast(queries, p, stop):
+                found.put((i, name, hits))
+        finally:
+            found.put((i, None, None))
+
+    names = list(queries)
+    order = {k: j for j, k in enumerate(names)}
+    progress = [-1] * len(dbs)  # last query each shard is done with
+    parts = defaultdict(list)
+    nxt = 0  # next query to hand out
+    running = len(dbs)
+
+    with ThreadPoolExecutor(max_workers=len(dbs)) as executor:
+        futures = [executor.submit(run, i, db) for i, db in enumerate(dbs)]
+        try:
+            while running:
+                i, name, hits = found.get()
+                if name is None:
+                    # Raises the error of the shard, if any
+                    futures[i].result()
+                    progress[i] = len(names)
+                    running -= 1
+                else:
+                    parts[name].append(hits)
+                    progress[i] = order[name]
+
+                while nxt < len(names) and nxt <= min(progress):
+                    name = names[nxt]
+                    if name in parts:
+                        yield name, pd.concat(parts.pop(name), ignore_index=True)
+                    nxt += 1
+        finally:
+            # A shard failed or the consumer stopped, don't wait for the rest
+            if not all(f.done() for f in futures):
+                stop.set()
+    return None
+
+
+@lru_cache(maxsize=None)
+def load_shards(fp):
+    '''
+    BLAST indices listed in a shard manifest, relative to the manifest, and
+    the length of the whole genome. Manifests from before we recorded it
+    ("dbsize") add up the shards; None if we can't tell, blastn then uses
+    the size of each shard.
+    '''
+    with open(fp, 'r') as file:
+        manifest = json.load(file)
+    dbs = [str(Path(fp).parent / i['index']) for i in manifest['shards']]
+    dbsize = manifest.get('dbsize')
+    if dbsize is None and all('size' in i for i in manifest['shards']):
+        dbsize = sum(i['size'] for i in manifest['shards'])
+    return dbs, dbsize
+
+
+def watch(proc, stop):
+    '''
+    Kill the process once the Event <stop> is set. Reading its output blocks
+    (eg while blastn loads the index), so someone else has to pull the plug;
+    run this in a thread.
+    '''
+    while proc.poll() is None:
+        if stop.wait(0.1):
+            proc.kill()
+            break
+    return None
+
+
+def binds_3prime(df, mn_matches):
+    '''
+    Could the primer bind at these hits (a table of blastn output)? The 3' end
+    of the primer has to be aligned, and its last <mn_matches> bases match.
+    Column-wise, one boolean per hit.
+    '''
+    # Is the 3' end of the primer aligned?
+    # qend .. End of alignment in query
+    # https://www.metagenomics.wiki/tools/blast/blastn-output-format-6
+    # (len(profile) != i['qlen']) .. no softclipping of ends allowed
+    aligned = df['qend'] == df['qlen']
+
+    # Are the last <mn_matches> bases matches? The BTOP string ends with the
+    # number of matches at the 3' end (if it ends w/ a gap or mismatch, there
+    # are none).
+    # https://stackoverflow.com/questions/5320525/regular-expression-to-match-last-number-in-a-string
+    # TODO: we discard too many? orientation blast/ primer ok?
+    # Primers which bind suboptimally everywhere are thus removed
+    matches = df['btop'].str.extract(MATCHES_3PRIME, expand=False).astype(float)
+    return aligned & (matches >= mn_matches)
+
+
+def blast_frame(rows, mn_matches=None):
+    '''
+    Hits (rows of blastn output) as a table, with their alignment profile
+    (see parse_blast_btop()). With <mn_matches>, only those where the primer
+    can bind (see binds_3prime()); the profile is only built for those.
+    '''
+    # Explicit types, so pandas does not have to guess (and eg BTOP "20"
+    # stays a string)
+    df = pd.DataFrame(rows, columns=BLAST_FIELDS).astype(BLAST_DTYPES)
+    if mn_matches is not None:
+        df = df[binds_3prime(df, mn_matches)].reset_index(drop=True)
+    df['aln'] = [btop_profile(i) for i in df['btop']]
+    return df
 
-    return results
 
+class Backend():
+    '''
+    What the specificity check (check_for_multiple_amplicons()) needs from a
+    search engine; blastn (BlastSearch), isPcr and our own index (see
+    primer4/backends.py, which also picks one according to the settings).
+
+    - prefetch(primers) .. search whatever we don't know yet, in one go
+    - amplicons(primer, stop) .. number of products of the pair, we may stop
+    counting once there are more than <stop>
+    - sites(primer) .. binding sites of the pair, {(name, orient, contig,
+    start, end): alignment profile}
+    - cancel() .. stop all searches, eg once enough pairs have passed
+
+    Engines that find binding sites of single oligos only implement
+    oligo_sites(), a table with one row per site (sseqid, sstart, send,
+    sstrand and aln, like BLAST), and the pairing is done here.
+    '''
+    runs = 0  # how often we ran the engine
+    cached = 0  # oligos (or pairs) we found in the cache instead
+
+    def __init__(self, params, cache=None):
+        self.params = params
+        self.cache = cache
+        self.stopped = Event()
+
+    def cancel(self):
+        self.stopped.set()
+
+    def prefetch(self, primers):
+        return None
+
+    def oligo_sites(self, oligo):
+        raise NotImplementedError
+
+    def amplicons(self, primer, stop=None):
+        return count_products(
+            self.oligo_sites(primer.fwd.sequence),
+            self.oligo_sites(primer.rev.sequence),
+            self.params['primers']['mx_amplicon_len'],
+            stop=stop)
+
+    def sites(self, primer):
+        # ('139b465b', 'rev', 'NT_113943.1', 41544, 41558): '..........|.|..'
+        lu = {}
+        for x in ['fwd', 'rev']:
+            df = self.oligo_sites(getattr(primer, x).sequence)
+            sub = df[['sseqid', 'sstart', 'send', 'aln']].drop_duplicates()
+            for i in sub.itertuples():
+                start, end = i.sstart, i.send
+                if start > end:
+                    start, end = end, start
+                lu[(primer.name, x, i.sseqid, start, end)] = i.aln
+        return lu
+
+
+class BlastSearch(Backend):
+    '''
+    Filtered BLAST hits per oligo. Each blastn run pays for loading the
+    index, so we search all candidates we know of in one go (prefetch) and
+    look them up from here when their batch is checked.
+
+    The same primers come back across queries (the same exon again, nearby
+    variants, another max_variation), so with a <cache> (see
+    primer4/cache.py) we keep the hits of each oligo on disk, too, and only
+    search oligos we have not seen before.
+
+    search = BlastSearch(params, cache)
+    search.prefetch(candidates)
+    search.oligo_sites('ACGTCTGAAAATGACCCTCACT')
+    # DataFrame, one row per site, columns as BLAST_FIELDS plus "aln"
+
+    Pairs are counted as the hits of their oligos come in: once both oligos
+    of a pair are there, a pair with more than <mx_amplicon_n> products is
+    rejected, and an oligo whose pairs are all rejected (eg a repetitive
+    primer) is dropped from memory right away. Should it come back with a
+    new partner, we read it from the cache (or search it) again.
+
+    Batches can be checked from several threads at once (see
+    check_streamed() in pipeline); an oligo another thread is already
+    searching is waited for, not searched again. cancel() stops all
+    searches, killing their blastn.
+    '''
+    def __init__(self, params, cache=None):
+        super().__init__(params, cache)
+        self.oligos = {}  # sequence: hits
+        self.pending = {}  # sequence: Event, set once its search is done
+        self.partners = defaultdict(set)  # sequence: pairs we were asked about
+        self.products = {}  # (fwd, rev): products, counted up to one too many
+        self.lock = Lock()
+        self.runs = 0
+        self.cached = 0
+
+    def __repr__(self):
+        return f'BlastSearch({len(self.oligos)} oligos, {len(self.products)} pairs counted, {self.runs} blastn runs, {self.cached} from cache)'
+
+    def key(self, oligo):
+        return oligo_key(oligo, self.params)
+
+    def prefetch(self, primers):
+        pairs = set((p.fwd.sequence, p.rev.sequence) for p in primers)
+
+        with self.lock:
+            pairs = set(p for p in pairs if not self.rejected(p))
+            for pair in pairs:
+                for oligo in pair:
+                    self.partners[oligo].add(pair)
+            wanted = set(chain(*pairs))
+            missing = wanted - set(self.oligos)
+            elsewhere = [self.pending[i] for i in missing if i in self.pending]
+            missing -= set(self.pending)
+            for oligo in missing:
+                self.pending[oligo] = Event()
 
-def check_for_multiple_amplicons(primers, fp_genome, params):
+        try:
+            self.search(missing)
+        finally:
+            with self.lock:
+                for oligo in missing:
+                    self.pending.pop(oligo).set()
+
+        for done in elsewhere:
+            done.wait()
+        with self.lock:
+            needed = set(chain(*(p for p in pairs if not self.rejected(p))))
+            if not needed.issubset(self.oligos):
+                # Another thread's search was cancelled
+                raise CancelledError()
+        return None
+
+    def search(self, missing):
+        missing = set(missing)
+        if self.cache is not None:
+            for oligo in list(missing):
+                hits = self.cache.get(self.key(oligo))
+                if hits is not None:
+                    self.add(oligo, hits)
+                    missing.remove(oligo)
+                    self.cached += 1
+        if not missing:
+            return None
+
+        queries = {f'oligo{i}': oligo for i, oligo in enumerate(sorted(missing))}
+        for name, hits in stream_shards(queries, self.params, self.stopped):
+            oligo = queries[name]
+            if self.cache is not None:
+                self.cache.set(self.key(oligo), hits)
+            self.add(oligo, hits)
+            missing.remove(oligo)
+
+        # No hits at all
+        for oligo in missing:
+            hits = blast_frame([])
+            if self.cache is not None:
+                self.cache.set(self.key(oligo), hits)
+            self.add(oligo, hits)
+        self.runs += 1
+        return None
+
+    def add(self, oligo, hits):
+        '''
+        Keep the hits of an oligo and count the pairs it completes; drop
+        the oligos of which no pair can pass anymore.
+        '''
+        mx_amplicon_n = self.params['primers']['mx_amplicon_n']
+        mx_amplicon_len = self.params['primers']['mx_amplicon_len']
+        with self.lock:
+            self.oligos[oligo] = hits
+            for fwd, rev in list(self.partners[oligo]):
+                if ((fwd, rev) in self.products) or not (
+                        (fwd in self.oligos) and (rev in self.oligos)):
+                    continue
+                self.products[(fwd, rev)] = count_products(
+                    self.oligos[fwd], self.oligos[rev], mx_amplicon_len,
+                    stop=mx_amplicon_n)
+                if self.rejected((fwd, rev)):
+                    self.drop(fwd)
+                    self.drop(rev)
+        return None
+
+    def rejected(self, pair):
+        return self.products.get(pair, 0) > self.params['primers']['mx_amplicon_n']
+
+    def drop(self, oligo):
+        # Only if no other pair needs its hits, call with the lock held
+        if all(self.rejected(p) for p in self.partners[oligo]):
+            self.oligos.pop(oligo, None)
+        return None
+
+    def amplicons(self, primer, stop=None):
+        # Counted as the hits came in, see add()
+        pair = (primer.fwd.sequence, primer.rev.sequence)
+        if pair in self.products:
+            return self.products[pair]
+        return super().amplicons(primer, stop)
+
+    def oligo_sites(self, oligo):
+        return self.oligos[oligo]
+
+
+def check_for_multiple_amplicons(primers, fp_genome, params, search=None):
     '''
     Params mostly from ISPCR from UCSC genome browser:
 
@@ -211,202 +798,86 @@ def check_for_multiple_amplicons(primers, fp_genome, params):
     mx_amplicon_len = 4000
     mx_amplicon_n = 1  # pseudogene and unwanted amplification check
     mn_matches = 15    # 3' matches
+
+    Sites and amplicons come from <search>, any Backend (see
+    primer4/backends.py), by default blastn. Keep the same one across the
+    batches of a query, so each oligo is only searched once.
     '''
-    mx_amplicon_len = params['primers']['mx_amplicon_len']
     mx_amplicon_n = params['primers']['mx_amplicon_n']
-    mn_matches = params['primers']['mn_3prime_matches']
-    
-    word_size = params['blast']['word_size']
-    mx_evalue = params['blast']['mx_evalue']
-    mx_blast_hits = params['blast']['mx_blast_hits']
-    n_cpus = params['blast']['n_cpus']
 
-    blast_index = params['blast']['index']
-
-    tmpdir = tempfile.TemporaryDirectory()
-    p = tmpdir.name
+    # Pairs share oligos (one fwd primer with several rev primers), so we
+    # search each sequence once and join the hits back to the pairs.
+    if search is None:
+        search = BlastSearch(params)
+    search.prefetch(primers)
 
+    # We should only find one product for each pair, which is the amplicon we
+    # want. Pairs are counted one at a time and given up on as soon as they
+    # have too many products, so we never put the hits of all pairs into one
+    # table.
+    print(log('Exclude non-unique sites'))
+    results, lu = [], {}
     for primer in primers:
-        primer.save(f'{p}/{primer.name}.fna')
-
-    fields = 'qseqid sseqid qlen slen pident length mismatch gapopen qstart qend sstart send evalue bitscore nident btop sstrand'
-    steps = [
-        f'cat {p}/*.fna > {p}/pseudo.fna',
-        f'blastn -dust no -word_size {word_size} -evalue {mx_evalue} -outfmt "6 {fields}" -query {p}/pseudo.fna -db {blast_index} -num_threads {n_cpus} -out {p}/result'
-    ]
-    '''
-    > The “Blast trace-back operations” (BTOP) string describes the alignment produced by BLAST. -- https://www.ncbi.nlm.nih.gov/books/NBK569862
-
-    Examples: 7AG39, 7A-39, 6-G-A41
-    '''
-    command = '; '.join(steps)
-    print(log(f'Search alternative binding sites for {len(primers)} pair(s)'))
-    _ = subprocess.run(command, capture_output=True, shell=True)
-    # log_blast = ...
-    # print(log_blast)
-    result = Path(p) / 'result'
-    df = pd.read_csv(result, sep='\t', names=fields.split(' '))
-    df = df.astype({'btop': str})
-    # print(df.iloc[0])
-    # print(f'Before: {len(set([i.split(".")[0] for i in df["qseqid"]]))}')
-    # print(len(df))
-    # print(df)
-    drop_these = []
-    aln_profiles = []
-    for ix, i in df.iterrows():
-        try:
-            # Try to parse the number of 3' matches (get the last number)
-            # https://stackoverflow.com/questions/5320525/regular-expression-to-match-last-number-in-a-string
-            # print(i['btop'])
-            profile, split = parse_blast_btop(i['btop'], debug=True)
-            aln_profiles.append(profile)
-            matches_3prime = split[-1]
-            # matches_3prime = int(re.match(r'.*?(\d+)(?!.*\d)', i['btop']).group(1))
-
-            # Is the 3' end of the primer aligned?
-            # qend .. End of alignment in query
-            # https://www.metagenomics.wiki/tools/blast/blastn-output-format-6
-            cond1 = i['qend'] != i['qlen']
-
-            # Are the last <mn_matches> bases matches?
-            cond2 = matches_3prime < mn_matches
-
-            # (len(profile) != i['qlen']) .. no softclipping of ends allowed
-            #if (matches_3prime < mn_matches) or (len(profile) != i['qlen']):
-            
-            # 4 debugging
-            log_profiles = [
-                    matches_3prime,
-                    i['qlen'],
-                    i['qend'],
-                    i['length'],
-                    len(split),
-                    i['sstrand'],
-                    i['btop'],
-                    cond1,
-                    cond2,
-                    profile]
-
-            if cond1 or cond2:
-                # TODO: we discard too many? orientation blast/ primer ok?
-                # print(log_profiles)
-                
-                # Primers which bind suboptimally everywhere are thus removed
-                drop_these.append(ix)
-                
-            # else:
-            #     print(log_profiles)
-
-        except ValueError:
-            # Gap or mismatch in last position, so cannot cast string to int
-            # invalid literal for int() with base 10: ...
+        n = search.amplicons(primer, stop=mx_amplicon_n)
+        if n > mx_amplicon_n:
+            print(f'Primer pair {primer.name} does not pass, {n}+ products')
             continue
+        results.append(primer)
+        lu.update(search.sites(primer))
 
-    df['aln'] = aln_profiles
-    # print(f'Dataframe before: {len(df)}')
-    df.drop(df.index[drop_these], inplace=True)
-    # print(df)
-    # print(f'Dataframe after: {len(df)}')
-    # print(f'Remaining: {len(set([i.split(".")[0] for i in df["qseqid"]]))}')
-    # print(len(df))
-    '''
-    qseqid        sseqid  pident  length  ...  nident  btop  sstrand                   aln
-    0    139b465b.fwd  NC_000017.10   100.0      20  ...      20    20     plus  ....................
-    1    139b465b.fwd  NC_000017.10   100.0      15  ...      15    15     plus       ...............
-    '''
-    sub = df[['qseqid', 'sseqid', 'sstart', 'send', 'aln']].drop_duplicates()
-    lu = {}
-    for i in sub.itertuples():
-        name, orient = i.qseqid.split('.')
-        start, end = i.sstart, i.send
-        if start > end:
-            start, end = end, start
-        lu[(name, orient, i.sseqid, start, end)] = i.aln
-
+    return results, lu
 
-    # lu = {tuple(k.split('.')): v for k, v in zip(sub.qseqid, sub.aln)}  
-    # Lookup for alignment string:
-    # ('139b465b', 'rev'): '...||................'
 
-    # import pdb; pdb.set_trace()
+def count_products(fwd, rev, mx_amplicon_len, stop=None):
+    '''
+    Number of products from the BLAST hits of a fwd and a rev primer: both on
+    the same contig, on different strands, facing each other and less than
+    <mx_amplicon_len> apart.
 
-    unique = set([i.split('.')[0] for i in df['qseqid']])
-    
-    print(log('Exclude non-unique sites'))
-    cnt = defaultdict(int)
-    for u in unique:
+    Instead of trying all combinations of hits, we sort the hits of the rev
+    primer per contig and strand and count the partners of each fwd hit with
+    two binary searches, so repetitive primers cost O((n + m) log m):
 
-        fwd_df = df[df['qseqid'] == f'{u}.fwd']
-        rev_df = df[df['qseqid'] == f'{u}.rev']
+    - fwd on plus, rev on minus: rev.sstart in (fwd.sstart, fwd.send + mx)
+    - fwd on minus, rev on plus: rev.sstart < fwd.sstart and
+    rev.send > fwd.sstart - mx, ie all rev hits that start left of fwd minus
+    those that also end too far left of it (they start left of it, too)
 
-        # If there are too many Blastn hits for a primer pair, the fwd-rev
-        # combinations explode thanks to combinatorics. So we make a hard cut
-        # and ignore these "abundant" sequences.
-        if (len(fwd_df) > mx_blast_hits) or (len(rev_df) > mx_blast_hits):
-            cnt[u] = np.Inf
+    With <stop>, we return as soon as there are more than <stop> products
+    (counted contig by contig), which is all we need to reject a pair.
+    '''
+    n = 0
+    for contig, i in fwd.groupby('sseqid'):
+        j = rev[rev['sseqid'] == contig]
+        if j.empty:
             continue
 
-        fwd = [dict(v) for _, v in fwd_df.iterrows()]
-        rev = [dict(v) for _, v in rev_df.iterrows()]
-    
-        # pr = list(product(fwd, rev))
-        # for i, j in tqdm(pr, total=len(pr)):
-        for i, j in product(fwd, rev):
-            # Same contig?
-            if not i['sseqid'] == j['sseqid']:
-                continue
-    
-            # Same chromosome and different strands?
-            fwd_strand, fwd_start = i['sstrand'], i['sstart']
-            rev_strand, rev_start = j['sstrand'], j['sstart']
-            
-            # Primers on different strands?
-            if not fwd_strand != rev_strand:
-                continue
-    
-            # Orientation right (otherwise polymerase walks in opposite directions)?
-            if fwd_strand == 'plus':
-                if not fwd_start < rev_start:
-                    continue
-            else:
-                if not fwd_start > rev_start:
-                    continue
-    
-            # Amplicon size?
-            if i['sstart'] > j['sstart']:
-                amplicon = i['sstart'] - j['send']
-            else:
-                amplicon = j['sstart'] - i['send']
-    
-            if amplicon < mx_amplicon_len:
-                cnt[u] += 1
-                # print(i)
-                # print(j)
-                # print(amplicon)
-                # print(i['qseqid'], i['sseqid'], i['sstart'], i['send'])
-                # print(j['qseqid'], j['sseqid'], j['sstart'], j['send'])
-
-    # We should only find one pair for each, which is the amplicon we want.
-    # import pdb; pdb.set_trace()
-    results = []
-    for primer in primers:
-        if cnt[primer.name] <= mx_amplicon_n:
-            results.append(primer)
-        else:
-            print(f'Primer pair {primer.name} does not pass, likely too unspecific (> {mx_blast_hits} Blast hits)')
-    # print(results)
-
-    del df
-    del _ 
-    del primers
-    del unique
-    del cnt
-    del sub
-    gc.collect()
-
-    return results, lu
-    # lu looks like this:
-    #  ... ('9434526f', 'rev', 'NT_113943.1', 41544, 41558): '..........|.|..',
+        i_plus = i[i['sstrand'] == 'plus']
+        j_minus = np.sort(j.loc[j['sstrand'] == 'minus', 'sstart'].values)
+        hi = np.searchsorted(j_minus, i_plus['send'].values + mx_amplicon_len, side='left')
+        lo = np.searchsorted(j_minus, i_plus['sstart'].values, side='right')
+        n += int(np.maximum(hi - lo, 0).sum())
+
+        s = i.loc[i['sstrand'] == 'minus', 'sstart'].values
+        j_plus = j[j['sstrand'] == 'plus']
+        starts = np.sort(j_plus['sstart'].values)
+        ends = np.sort(j_plus['send'].values)
+        left_of = np.searchsorted(starts, s, side='left')
+        too_far = np.searchsorted(ends, s - mx_amplicon_len, side='right')
+        n += int(np.maximum(left_of - too_far, 0).sum())
+        if (stop is not None) and (n > stop):
+            break
+    return n
+
+
+@lru_cache(maxsize=4096)
+def btop_profile(s):
+    '''
+    parse_blast_btop(s), remembered: most hits of a primer are perfect or
+    near perfect, so the same few BTOP strings ("20", "15", ...) come up
+    over and over.
+    '''
+    return parse_blast_btop(s)
 
 
 def parse_blast_btop(s, debug=False):
@@ -488,8 +959,8 @@ def project_mask_onto_primers(primers, mask, mn_3prime_matches=15):
         mask = set()
 
     for x in ['fwd', 'rev']:
-        start = primers.data[x]['start']
-        end = primers.data[x]['end']
+        primer = getattr(primers, x)
+        start, end = primer.start, primer.end
         #print(x, start, end)
         
         z = [('|', i) if i in mask else ('.', i) for i in range(start, end)]
@@ -498,8 +969,8 @@ def project_mask_onto_primers(primers, mask, mn_3prime_matches=15):
         # positions of the primer have an SNV: ".|......|"
         dots =  ''.join([i for i, _ in z])
         pos = [j for i, j in z if i == '|']
-        assert len(dots) == len(primers.data[x]['sequence']), \
-            f'{x}, {dots}, {primers.data[x]["sequence"]}'
+        assert len(dots) == len(primer.sequence), \
+            f'{x}, {dots}, {primer.sequence}'
 
         valid = not '|' in dots[-mn_3prime_matches:]
         d[x] = (valid, dots, pos)
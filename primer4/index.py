@@ -0,0 +1,276 @@
+'''
+In-silico PCR against our own index of the reference genome, instead of
+BLAST (or isPcr). Build the index once per genome release:
+
+python scripts/build_index.py --genome redux.fna --out redux.p4i
+
+and then:
+
+index = GenomeIndex('redux.p4i')
+index.sites('ACGTCTGAAAATGACCCTCACT', mn_3prime_matches=15, mx_mismatches=2)
+# [Site(contig='NC_000017.11', start=7675994, end=7676015, strand='plus', aln='......................'), ...]
+
+The specificity check uses it through IndexBackend (see primer4/backends.py).
+
+The index is a table of all positions in the genome, sorted by the k-mer
+(k=13) that starts there, plus an offset for each k-mer where its positions
+start (a truncated suffix array). The 3' end of a primer has to match
+exactly anyway (see check_for_multiple_amplicons() in design), so we look up
+the k-mer at the 3' end and only compare the rest of the primer at the few
+positions we get back. Everything is memory mapped, so the index loads
+instantly and only the pages we touch are read.
+
+Layout of the index directory:
+
+- manifest.json .. k and the contigs (name, offset, length)
+- seq.npy .. the genome, one byte per base (A 0, C 1, G 2, T 3, other 4),
+contigs separated by one "other"
+- offsets.npy .. where the positions of k-mer i start in pos.npy
+- pos.npy .. positions, sorted by k-mer and then position
+'''
+from collections import namedtuple
+from functools import lru_cache
+import json
+from pathlib import Path
+
+import numpy as np
+
+from primer4.utils import log
+
+
+# ASCII to base code, anything we don't know (N, IUPAC codes) is 4
+ENCODE = np.full(256, 4, dtype=np.uint8)
+for i, base in enumerate('ACGT'):
+    ENCODE[ord(base)] = i
+    ENCODE[ord(base.lower())] = i
+
+# Complement of a base code
+COMPLEMENT = np.array([3, 2, 1, 0, 4], dtype=np.uint8)
+
+Site = namedtuple('Site', 'contig start end strand aln')
+
+
+def encode(seq):
+    return ENCODE[np.frombuffer(seq.encode(), dtype=np.uint8)]
+
+
+def kmer_codes(seq, k):
+    '''
+    Integer code of each k-mer in the (encoded) sequence, -1 if the k-mer
+    contains anything but ACGT.
+    '''
+    n = len(seq) - k + 1
+    if n < 1:
+        return np.zeros(0, dtype=np.int64)
+
+    codes = np.zeros(n, dtype=np.int64)
+    invalid = np.zeros(n, dtype=bool)
+    for j in range(k):
+        x = seq[j:j + n]
+        codes = (codes << 2) | (x & 3)
+        invalid |= x > 3
+    codes[invalid] = -1
+    return codes
+
+
+def build_index(contigs, out, k=13, chunk_size=2**24):
+    '''
+    contigs .. iterable of (name, sequence), eg from screed
+
+    Two passes over the genome: first we write the sequence and count the
+    k-mers, then we put each position into the slot of its k-mer. Done in
+    chunks, so we never hold more than <chunk_size> positions in memory
+    (besides the sequence itself, which we need to write anyway).
+    '''
+    out = Path(out)
+    out.mkdir(parents=True, exist_ok=True)
+
+    manifest = {'k': k, 'contigs': []}
+    total = 0
+    with open(out / 'seq.tmp', 'wb') as file:
+        for name, seq in contigs:
+            x = encode(seq)
+            file.write(x.tobytes())
+            file.write(bytes([4]))  # separator
+            manifest['contigs'].append(
+                {'name': name, 'offset': total, 'length': len(seq)})
+            total += len(seq) + 1
+            print(log(f'Read {name} ({len(seq)} bp)'))
+
+    raw = np.memmap(out / 'seq.tmp', dtype=np.uint8, mode='r', shape=(total,))
+    seq = np.lib.format.open_memmap(
+        out / 'seq.npy', mode='w+', dtype=np.uint8, shape=(total,))
+    seq[:] = raw
+    seq.flush()
+    del raw
+    (out / 'seq.tmp').unlink()
+
+    def chunks():
+        # k-mers overlap the chunk boundaries, so we read k - 1 extra bases
+        for start in range(0, total, chunk_size):
+            codes = kmer_codes(seq[start:start + chunk_size + k - 1], k)
+            yield start, codes[:chunk_size]
+
+    counts = np.zeros(4 ** k, dtype=np.int64)
+    for _, codes in chunks():
+        kmers, n = np.unique(codes[codes >= 0], return_counts=True)
+        counts[kmers] += n
+
+    offsets = np.zeros(4 ** k + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    np.save(out / 'offsets.npy', offsets)
+
+    dtype = np.uint32 if total < 2 ** 32 else np.uint64
+    pos = np.lib.format.open_memmap(
+        out / 'pos.npy', mode='w+', dtype=dtype, shape=(int(offsets[-1]),))
+
+    cursor = offsets[:-1].copy()
+    for start, codes in chunks():
+        valid = np.flatnonzero(codes >= 0)
+        c = codes[valid]
+        order = np.argsort(c, kind='stable')
+        c, p = c[order], valid[order] + start
+        # Rank of each position among those of the same k-mer in this chunk
+        kmers, first, n = np.unique(c, return_index=True, return_counts=True)
+        rank = np.arange(len(c)) - np.repeat(first, n)
+        pos[cursor[c] + rank] = p
+        cursor[kmers] += n
+        print(log(f'Indexed {min(start + chunk_size, total)}/{total} positions'))
+    pos.flush()
+
+    with open(out / 'manifest.json', 'w+') as file:
+        json.dump(manifest, file, indent=4)
+    return None
+
+
+class GenomeIndex():
+    '''
+    See module docstring.
+    '''
+    def __init__(self, fp):
+        self.fp = Path(fp)
+        with open(self.fp / 'manifest.json', 'r') as file:
+            manifest = json.load(file)
+        self.k = manifest['k']
+        self.contigs = [i['name'] for i in manifest['contigs']]
+        self.starts = np.array([i['offset'] for i in manifest['contigs']])
+        self.seq = np.load(self.fp / 'seq.npy', mmap_mode='r')
+        self.offsets = np.load(self.fp / 'offsets.npy', mmap_mode='r')
+        self.pos = np.load(self.fp / 'pos.npy', mmap_mode='r')
+
+    def __repr__(self):
+        return f'GenomeIndex({self.fp}, {len(self.contigs)} contigs, k={self.k})'
+
+    def lookup(self, kmer):
+        '''
+        Positions of the (encoded) k-mer in the genome.
+        '''
+        code = 0
+        for b in kmer:
+            if b > 3:
+                return np.zeros(0, dtype=np.int64)
+            code = (code << 2) | int(b)
+        return self.pos[self.offsets[code]:self.offsets[code + 1]].astype(np.int64)
+
+    def search(self, oligo, mn_3prime_matches=15, mx_mismatches=2):
+        '''
+        Where does the oligo bind, with the <mn_3prime_matches> bases at its 3'
+        end matching exactly and at most <mx_mismatches> elsewhere? Returns
+        the leftmost positions (0-based, in the concatenated genome), the
+        strands (True for plus) and the mismatch profiles of the sites.
+        '''
+        q = encode(oligo)
+        n = len(q)
+        exact = min(mn_3prime_matches, n)
+        if exact < self.k:
+            raise ValueError(f'Need at least {self.k} exact 3\' matches to search the index')
+
+        left, strand, profiles = [], [], []
+        # Plus strand: the genome reads like the oligo, 3' end on the right
+        # Minus strand: the genome reads like its reverse complement, 3' end
+        # on the left
+        rc = COMPLEMENT[q[::-1]]
+        for plus, x in [(True, q), (False, rc)]:
+            if plus:
+                hits = self.lookup(x[n - self.k:]) - (n - self.k)
+            else:
+                hits = self.lookup(x[:self.k])
+            hits = hits[(hits >= 0) & (hits + n <= len(self.seq))]
+            if not len(hits):
+                continue
+
+            windows = self.seq[hits[:, None] + np.arange(n)]
+            mismatch = windows != x
+            anchor = slice(n - exact, n) if plus else slice(0, exact)
+            ok = ~mismatch[:, anchor].any(axis=1) & (mismatch.sum(axis=1) <= mx_mismatches)
+            # No site across two contigs (or Ns in the reference)
+            ok &= (windows < 4).all(axis=1)
+
+            left.append(hits[ok])
+            strand.append(np.full(ok.sum(), plus))
+            # 5' to 3' of the oligo, like parse_blast_btop()
+            m = mismatch[ok] if plus else mismatch[ok][:, ::-1]
+            profiles.extend(
+                ''.join('|' if i else '.' for i in row) for row in m)
+
+        if not left:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=bool), []
+        return np.concatenate(left), np.concatenate(strand), profiles
+
+    def locate(self, left, strand, profiles, length):
+        '''
+        Turn the result of search() into sites on the contigs.
+        '''
+        ix = np.searchsorted(self.starts, left, side='right') - 1
+        return [
+            Site(
+                self.contigs[c],
+                # 1-based and inclusive, like BLAST
+                int(l - self.starts[c] + 1),
+                int(l - self.starts[c] + length),
+                'plus' if s else 'minus',
+                aln)
+            for l, s, c, aln in zip(left, strand, ix, profiles)]
+
+    def sites(self, oligo, mn_3prime_matches=15, mx_mismatches=2):
+        left, strand, profiles = self.search(oligo, mn_3prime_matches, mx_mismatches)
+        return self.locate(left, strand, profiles, len(oligo))
+
+
+@lru_cache(maxsize=None)
+def load_index(fp):
+    '''
+    One GenomeIndex per path and process, see IndexBackend in backends.
+    '''
+    print(log(f'Open genome index {fp}'))
+    return GenomeIndex(fp)
+
+
+def count_amplicons(a, b, mx_amplicon_len, starts):
+    '''
+    Number of products from oligo a on the plus and oligo b on the minus
+    strand. a and b are (left, strand, length) from GenomeIndex.search() in
+    genome coordinates, <starts> are where the contigs begin in them
+    (GenomeIndex.starts).
+
+    Same rules as count_products() in design: b has to end right of where a
+    starts, on the same contig, and the product (from the end of a to the end
+    of b) be shorter than <mx_amplicon_len>. For sorted ends of b that is
+    two binary searches per site of a; the window of a site ends at the end
+    of its contig at the latest, so we count per contig.
+    '''
+    a_left, a_strand, a_len = a
+    b_left, b_strand, b_len = b
+    start = a_left[a_strand]
+    end = np.sort(b_left[~b_strand] + b_len)
+    if not len(start) or not len(end):
+        return 0
+
+    # Start of the next contig for each site of a, like in locate()
+    contig = np.searchsorted(starts, start, side='right') - 1
+    bounds = np.append(np.asarray(starts, dtype=np.int64)[1:], np.iinfo(np.int64).max)
+    limit = np.minimum(start + a_len + mx_amplicon_len, bounds[contig])
+
+    lo = np.searchsorted(end, start + 1, side='right')
+    hi = np.searchsorted(end, limit, side='left')
+    return int(np.maximum(hi - lo, 0).sum())
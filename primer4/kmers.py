@@ -0,0 +1,242 @@
+'''
+How often does the 3' end of a primer occur in the genome? A primer whose
+last <mn_3prime_matches> bases sit at hundreds of places will almost always
+make more than one product, so we don't need BLAST to tell us.
+
+Build the table once per genome release:
+
+python scripts/build_kmer_counts.py --genome redux.fna --out redux.k15.npy
+
+and then:
+
+counts = KmerCounts('redux.k15.npy')
+counts.count('ACGTCTGAAAATGACCCTCACT')
+# 1, occurrences of the last 15 bases on both strands (at most 255)
+
+For masking repeats before the design there is a track of which positions
+start a unique (longer) k-mer, see MappabilityTrack.
+
+The table holds one byte for each of the 4^k k-mers (1 GB for k=15), the
+index is the k-mer's code (see kmer_codes() in primer4/index.py), so a
+lookup is a single read. It is memory mapped, so all processes (eg the
+design workers) share the pages the OS has cached.
+'''
+from functools import lru_cache
+import json
+from pathlib import Path
+
+import numpy as np
+
+from primer4.index import COMPLEMENT, encode, kmer_codes
+from primer4.utils import log
+
+
+# Counts are capped, we only care about "a lot"
+MX_COUNT = 255
+
+
+def build_kmer_counts(contigs, out, k=15, chunk_size=2**24):
+    '''
+    contigs .. iterable of (name, sequence), eg from screed
+
+    Counts each k-mer and its reverse complement, ie where a primer ending
+    in the k-mer could bind on either strand.
+    '''
+    counts = np.lib.format.open_memmap(
+        out, mode='w+', dtype=np.uint8, shape=(4 ** k,))
+
+    def add(codes):
+        kmers, n = np.unique(codes[codes >= 0], return_counts=True)
+        x = counts[kmers].astype(np.int64) + n
+        counts[kmers] = np.minimum(x, MX_COUNT)
+
+    for name, seq in contigs:
+        x = encode(seq)
+        # k-mers overlap the chunk boundaries, so we read k - 1 extra bases
+        for start in range(0, len(x), chunk_size):
+            chunk = x[start:start + chunk_size + k - 1]
+            add(kmer_codes(chunk, k))
+            add(kmer_codes(COMPLEMENT[chunk[::-1]], k))
+        print(log(f'Counted {name} ({len(seq)} bp)'))
+
+    counts.flush()
+    return None
+
+
+class KmerCounts():
+    '''
+    See module docstring.
+    '''
+    def __init__(self, fp):
+        self.fp = fp
+        self.counts = np.load(fp, mmap_mode='r')
+        self.k = int(round(np.log(len(self.counts)) / np.log(4)))
+
+    def __repr__(self):
+        return f'KmerCounts({self.fp}, k={self.k})'
+
+    def count(self, oligo):
+        '''
+        Occurrences of the last k bases of the oligo, 0 if they contain
+        anything but ACGT.
+        '''
+        codes = kmer_codes(encode(oligo[-self.k:]), self.k)
+        if not len(codes) or codes[0] < 0:
+            return 0
+        return int(self.counts[codes[0]])
+
+    def passes(self, primer, mx_count):
+        '''
+        Do the 3' ends of both primers of a pair occur at most <mx_count>
+        times?
+        '''
+        return all(
+            self.count(getattr(primer, x).sequence) <= mx_count
+            for x in ['fwd', 'rev'])
+
+
+@lru_cache(maxsize=None)
+def load_kmer_counts(fp):
+    '''
+    One KmerCounts per path and process, see check_streamed() in pipeline.
+    '''
+    print(log(f'Open k-mer counts {fp}'))
+    return KmerCounts(fp)
+
+
+def canonical_codes(seq, k):
+    '''
+    Code of each k-mer or of its reverse complement, whichever is smaller, so
+    both strands count as the same k-mer; -1 if it contains anything but
+    ACGT.
+    '''
+    codes = kmer_codes(seq, k)
+    rc = kmer_codes(COMPLEMENT[seq[::-1]], k)[::-1]
+    return np.minimum(codes, rc)
+
+
+def build_mappability(contigs, out, k=24, mx_count=1, n_parts=64, chunk_size=2**24):
+    '''
+    Is the k-mer starting at a position unique in the genome (both strands,
+    at most <mx_count> times)? One bit per base, packed, one file per contig
+    in the directory <out>, plus a manifest (see MappabilityTrack).
+
+    k is too large for a table of all k-mers (see build_kmer_counts()), so we
+    count them exactly, in <n_parts> partitions on disk: one pass to spread
+    the k-mers over the partitions, one to find the repeated ones in each,
+    and one to look up the k-mer at each position.
+    '''
+    assert k < 32, 'k-mer codes have to fit into int64'
+    assert chunk_size % 8 == 0, 'Chunks have to be whole bytes in the track'
+    out = Path(out)
+    tmp = out / 'tmp'
+    tmp.mkdir(parents=True, exist_ok=True)
+
+    def chunks(x):
+        # k-mers overlap the chunk boundaries, so we read k - 1 extra bases;
+        # the last k - 1 positions of a contig don't start a k-mer (-1)
+        for start in range(0, len(x), chunk_size):
+            n = min(chunk_size, len(x) - start)
+            codes = np.full(n, -1, dtype=np.int64)
+            c = canonical_codes(x[start:start + chunk_size + k - 1], k)[:n]
+            codes[:len(c)] = c
+            yield codes
+
+    manifest = {'k': k, 'mx_count': mx_count, 'contigs': []}
+    parts = [open(tmp / f'{i}.bin', 'wb') for i in range(n_parts)]
+    for i, (name, seq) in enumerate(contigs):
+        x = encode(seq)
+        np.save(tmp / f'{i}.npy', x)
+        manifest['contigs'].append(
+            {'name': name, 'length': len(seq), 'file': f'{i}.npy'})
+        for codes in chunks(x):
+            codes = codes[codes >= 0]
+            part = codes % n_parts
+            order = np.argsort(part, kind='stable')
+            bounds = np.cumsum(np.bincount(part, minlength=n_parts))[:-1]
+            for file, c in zip(parts, np.split(codes[order], bounds)):
+                file.write(c.tobytes())
+        print(log(f'Read {name} ({len(seq)} bp)'))
+    for file in parts:
+        file.close()
+
+    repeated = []
+    for i in range(n_parts):
+        codes = np.fromfile(tmp / f'{i}.bin', dtype=np.int64)
+        kmers, n = np.unique(codes, return_counts=True)
+        repeated.append(kmers[n > mx_count])
+        (tmp / f'{i}.bin').unlink()
+    repeated = np.sort(np.concatenate(repeated))
+    print(log(f'{len(repeated)} repeated {k}-mers'))
+
+    for contig in manifest['contigs']:
+        x = np.load(tmp / contig['file'], mmap_mode='r')
+        packed = []
+        for codes in chunks(x):
+            ix = np.searchsorted(repeated, codes)
+            found = np.zeros(len(codes), dtype=bool)
+            inside = ix < len(repeated)
+            found[inside] = repeated[ix[inside]] == codes[inside]
+            packed.append(np.packbits((codes >= 0) & ~found))
+        np.save(out / contig['file'], np.concatenate(packed + [np.zeros(0, dtype=np.uint8)]))
+        del x
+        (tmp / contig['file']).unlink()
+        print(log(f'Mapped {contig["name"]}'))
+    tmp.rmdir()
+
+    with open(out / 'manifest.json', 'w+') as file:
+        json.dump(manifest, file, indent=4)
+    return None
+
+
+class MappabilityTrack():
+    '''
+    Which bases start a k-mer that is unique in the genome? Built with
+    build_mappability() or scripts/build_mappability.py:
+
+    track = MappabilityTrack('redux.k24.map')
+    track.query('NC_000017.11', 7675993, 7676015)
+    # array([ True,  True, ...]), one per base, 0-based and end-exclusive
+
+    Each contig is a memory mapped array of bits, so a query only reads the
+    bytes of its window.
+    '''
+    def __init__(self, fp):
+        self.fp = Path(fp)
+        with open(self.fp / 'manifest.json', 'r') as file:
+            manifest = json.load(file)
+        self.k = manifest['k']
+        self.contigs = {i['name']: i for i in manifest['contigs']}
+        self.bits = {}
+
+    def __repr__(self):
+        return f'MappabilityTrack({self.fp}, {len(self.contigs)} contigs, k={self.k})'
+
+    def query(self, contig, start, end):
+        '''
+        Contigs that are not in the track (eg alternate loci, see
+        scripts/prep_genome_4blast.py) count as unique; we can't say, so we
+        don't mask them.
+        '''
+        unique = np.ones(end - start, dtype=bool)
+        if contig not in self.contigs:
+            return unique
+
+        info = self.contigs[contig]
+        if contig not in self.bits:
+            self.bits[contig] = np.load(self.fp / info['file'], mmap_mode='r')
+        lo, hi = max(start, 0), min(end, info['length'])
+        if lo >= hi:
+            return unique
+        x = np.unpackbits(self.bits[contig][lo // 8:(hi + 7) // 8])
+        unique[lo - start:hi - start] = x[lo % 8:lo % 8 + hi - lo].astype(bool)
+        return unique
+
+
+@lru_cache(maxsize=None)
+def load_mappability(fp):
+    '''
+    One MappabilityTrack per path and process.
+    '''
+    print(log(f'Open mappability track {fp}'))
+    return MappabilityTrack(fp)
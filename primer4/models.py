@@ -1,12 +1,13 @@
 from collections import Counter
+import hashlib
 import re
-from uuid import uuid4
 
 import click
 from gffutils.feature import Feature
 import hgvs
 from hgvs.assemblymapper import AssemblyMapper
 import numpy as np
+import pandas as pd
 import pyfaidx
 from pysam import VariantFile
 
@@ -18,6 +19,7 @@ from primer4.utils import (
     load_variation_freqs,
     log,
     manual_c_to_g,
+    mask_sequence,
     find_nearest,
     )
     # sync_tx_with_feature_db)
@@ -243,6 +245,7 @@ class Template():
             )
         self.start, self.end = pythonic_boundaries(self.feat)
         self.mask = set()
+        self.unique = None  # mappability, see load_mappability_()
         self.mask_freqs = {}
         self.methods = {
             'sanger': sanger,
@@ -310,6 +313,26 @@ class Template():
         self.mask = mask
         return None
 
+    def load_mappability_(self, track):
+        '''
+        Does the k-mer starting at a position occur only once in the genome
+        (see MappabilityTrack in primer4/kmers.py)? A boolean array, one per
+        base of the template. Kept apart from the SNVs in self.mask, which we
+        also use to filter and annotate the primers.
+        '''
+        self.unique = track.query(self.feat.chrom, self.start, self.end)
+        return None
+
+    def masked_sequence(self, snvs=True):
+        '''
+        The template with N where primer3 must not put a primer: SNVs (unless
+        <snvs> is False, eg for the blind search) and repeats.
+
+        masked = tmp.masked_sequence()
+        '''
+        var = self.mask if snvs else set()
+        return mask_sequence(self.sequence, var, unique=self.unique)
+
     def get_exons(self, feature_db):
         '''
         Get all exons for the template's transcript and sort them by their start
@@ -375,10 +398,38 @@ class Template():
     #     return masked.upper()
 
 
+class Primer():
+    '''
+    One primer of a pair, positions are relative to the template.
+    '''
+    __slots__ = ('start', 'end', 'sequence', 'Tm')
+
+    def __init__(self, start, end, sequence, Tm=None):
+        self.start = start
+        self.end = end
+        self.sequence = sequence
+        self.Tm = Tm
+
+    def __repr__(self):
+        return f'{self.start}-{self.end}:{self.sequence}'
+
+    def to_dict(self):
+        return {
+            'start': self.start,
+            'end': self.end,
+            'sequence': self.sequence,
+            'Tm': self.Tm,
+        }
+
+
 class PrimerPair():
     '''
-    https://stackoverflow.com/questions/1305532/convert-nested-python-dict-to-object/9413295#9413295
+    We hold hundreds of candidates per query, so a pair is a flat object with
+    slots (no __dict__) instead of a tree of nested objects.
 
+    pair = PrimerPair({'fwd': {...}, 'rev': {...}, 'insert': 421, 'penalty': 0.7})
+    pair.fwd.start
+    # 10896
     pair.data['fwd']
     
     {
@@ -388,26 +439,56 @@ class PrimerPair():
         "Tm": 59.63
     }
 
+    The name is derived from the coordinates and sequences, so the same pair
+    found twice (eg with and without SNV masking) has the same name. It is
+    short, for display (and BLAST query names); two different pairs could
+    share it, so to tell pairs apart, compare their key().
+
     TODO: Add mismatches
     '''
-    def __init__(self, d):
-        self.name = uuid4().__str__().split('-')[0]
-        self.data = d
+    __slots__ = ('name', 'fwd', 'rev', 'insert', 'penalty', 'offset')
 
-        for a, b in d.items():
-            if isinstance(b, (list, tuple)):
-               setattr(self, a, [PrimerPair(x) if isinstance(x, dict) else x for x in b])
-            else:
-               setattr(self, a, PrimerPair(b) if isinstance(b, dict) else b)
+    def __init__(self, d):
+        self.fwd = Primer(**d['fwd'])
+        self.rev = Primer(**d['rev'])
+        self.insert = d.get('insert')
+        self.penalty = d.get('penalty')
+        self.name = self.digest()
         self.offset = 0  # store amplicon len offset when in mRNA mode
 
     def __repr__(self):
         return f'{self.fwd.start}-{self.fwd.end}:{self.rev.start}-{self.rev.end}, loss: {self.penalty}'
 
+    def key(self):
+        '''
+        Coordinates and sequences; two pairs with the same key are the same
+        pair, whichever design pass found them.
+        '''
+        f, r = self.fwd, self.rev
+        return (f.start, f.end, f.sequence, r.start, r.end, r.sequence)
+
+    def digest(self):
+        x = '|'.join(str(i) for i in self.key())
+        # 8 characters like the uuid4 prefix we used to use
+        return hashlib.blake2b(x.encode(), digest_size=4).hexdigest()
+
+    @property
+    def data(self):
+        '''
+        The pair as a dict, like the one it was created from. Built on every
+        access, so in loops rather read the slots (pair.fwd.start etc.).
+        '''
+        return {
+            'fwd': self.fwd.to_dict(),
+            'rev': self.rev.to_dict(),
+            'insert': self.insert,
+            'penalty': self.penalty,
+        }
+
     def save(self, fp):
         with open(fp, 'w+') as out:
             for i in ['fwd', 'rev']:
-                out.write(f'>{self.name}.{i}\n{self.data[i]["sequence"]}\n')
+                out.write(f'>{self.name}.{i}\n{getattr(self, i).sequence}\n')
 
     def get_amplicon_len(self):
         if self.offset:
@@ -416,7 +497,7 @@ class PrimerPair():
             return self.rev.end - self.fwd.start  # Sanger, qPCR
 
     def get_gc(self, direction):
-        seq = self.data[direction]['sequence']
+        seq = getattr(self, direction).sequence
         cnt = Counter(seq)
         return round((cnt['C'] + cnt['G']) / len(seq), 4)
 
@@ -424,8 +505,8 @@ class PrimerPair():
         if not orient or orient not in ['fwd', 'rev']:
             raise ValueError('Please provide an orientation [fwd|rev]')
         chrom = template.feat.chrom
-        start = template.invert_relative_pos(self.data[orient]['start'])
-        end = template.invert_relative_pos(self.data[orient]['end'])
+        start = template.invert_relative_pos(getattr(self, orient).start)
+        end = template.invert_relative_pos(getattr(self, orient).end)
         if not start < end:
             start, end = end, start
         start += 1  # + 1 bc/ SNPcheck validation 
@@ -441,5 +522,141 @@ class PrimerPair():
         return chrom, c_start, c_end
 
 
+class PrimerTable():
+    '''
+    Candidate pairs in columns (a numpy structured array), so we can sort,
+    filter and check them against the SNV mask in one go instead of pair by
+    pair. The PrimerPair objects stay in the same order in .primers.
+
+    table = PrimerTable(primers)
+    table = table.sort()
+    table['penalty']
+    # array([0.71, 1.02, ...])
+    valid_fwd, valid_rev = table.snv_free(tmp.mask, 15)
+    table.take(valid_fwd & valid_rev).primers
+    '''
+    dtype = [
+        ('name', 'O'),
+        ('penalty', 'f8'),
+        ('insert', 'i8'),
+        ('offset', 'i8'),
+        ('fwd_start', 'i8'),
+        ('fwd_end', 'i8'),
+        ('rev_start', 'i8'),
+        ('rev_end', 'i8'),
+        ('fwd_len', 'i8'),
+        ('rev_len', 'i8'),
+        ('fwd_Tm', 'f8'),
+        ('rev_Tm', 'f8'),
+        ('fwd_GC', 'f8'),
+        ('rev_GC', 'f8'),
+        ('fwd_seq', 'O'),
+        ('rev_seq', 'O'),
+    ]
+
+    def __init__(self, primers):
+        self.primers = list(primers)
+        rows = []
+        for p in self.primers:
+            rows.append((
+                p.name,
+                p.penalty if p.penalty is not None else np.nan,
+                p.insert or 0,
+                p.offset,
+                p.fwd.start,
+                p.fwd.end,
+                p.rev.start,
+                p.rev.end,
+                len(p.fwd.sequence),
+                len(p.rev.sequence),
+                p.fwd.Tm if p.fwd.Tm is not None else np.nan,
+                p.rev.Tm if p.rev.Tm is not None else np.nan,
+                p.get_gc('fwd'),
+                p.get_gc('rev'),
+                p.fwd.sequence,
+                p.rev.sequence,
+                ))
+        self.table = np.array(rows, dtype=self.dtype)
+
+    def __repr__(self):
+        return f'PrimerTable({len(self)} pairs)'
+
+    def __len__(self):
+        return len(self.primers)
+
+    def __getitem__(self, column):
+        return self.table[column]
+
+    def take(self, ix):
+        '''
+        Subset by index array or boolean mask, eg the result of argsort.
+        '''
+        ix = np.arange(len(self))[ix]
+        t = PrimerTable([])
+        t.primers = [self.primers[i] for i in ix]
+        t.table = self.table[ix]
+        return t
+
+    def sort(self):
+        # Stable, so pairs w/ the same penalty keep the order primer3 gave
+        return self.take(np.argsort(self.table['penalty'], kind='stable'))
+
+    def snv_counts(self, mask):
+        '''
+        Prefix sums over the mask: the number of SNVs between positions a and
+        b is counts[b] - counts[a].
+        '''
+        n = int(max(self.table['fwd_end'].max(), self.table['rev_end'].max()))
+        m = np.zeros(n, dtype=np.int64)
+        pos = [i for i in mask if 0 <= i < n]
+        m[pos] = 1
+        return np.concatenate([[0], np.cumsum(m)])
+
+    def snv_free(self, mask, mn_3prime_matches=15):
+        '''
+        Which fwd and rev primers have no SNV in their last <mn_3prime_matches>
+        positions, same as project_mask_onto_primers() in design.
+        '''
+        if not len(self) or not mask:
+            return np.ones(len(self), dtype=bool), np.ones(len(self), dtype=bool)
+
+        counts = self.snv_counts(mask)
+        result = []
+        for x in ['fwd', 'rev']:
+            start, end = self.table[f'{x}_start'], self.table[f'{x}_end']
+            tail = np.maximum(start, end - mn_3prime_matches)
+            result.append((counts[end] - counts[tail]) == 0)
+        return tuple(result)
+
+    def dots(self, mask):
+        '''
+        SNVs in dot notation for the fwd and rev primers, "." means no SNV,
+        "|" means SNV, eg the 2nd and last positions of the primer:
+        ".|......|"
 
+        dots_fwd, dots_rev = table.dots(tmp.mask)
 
+        Each primer only looks at the SNVs between its start and end (two
+        binary searches in the sorted mask), not at the whole template.
+        '''
+        pos = np.sort(np.fromiter(mask or [], dtype=np.int64))
+        result = []
+        for x in ['fwd', 'rev']:
+            start, end = self.table[f'{x}_start'], self.table[f'{x}_end']
+            lo = np.searchsorted(pos, start, side='left')
+            hi = np.searchsorted(pos, end, side='left')
+            dots = []
+            for i, j, a, b in zip(start, end, lo, hi):
+                d = ['.'] * (j - i)
+                for k in pos[a:b]:
+                    d[k - i] = '|'
+                dots.append(''.join(d))
+            result.append(dots)
+        return tuple(result)
+
+    def to_df(self):
+        '''
+        One column per field; the numeric columns are taken from the table as
+        they are, without going through the pairs again.
+        '''
+        return pd.DataFrame({k: self.table[k] for k, _ in self.dtype})
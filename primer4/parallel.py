@@ -0,0 +1,135 @@
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from queue import Empty, Full
+
+from primer4.design import stream_primers
+
+
+def iter_designs(jobs, params):
+    '''
+    Lazily hand out the primer pairs of several design jobs, one job after
+    the other, same order as DesignPool.iter() on several workers. No job
+    does more primer3 work than the pairs we actually ask for; a job whose
+    turn never comes never runs.
+
+    for p in iter_designs([(masked, constraints), (nomask, constraints)], params):
+        ...
+    '''
+    for masked, c in jobs:
+        yield from stream_primers(masked, c, params)
+
+
+def stream_design(masked, constraints, params, queue, stop):
+    '''
+    One design job on a worker of DesignPool.iter(): put the pairs onto the
+    job's (manager) queue as primer3 selects them, and None once the job is
+    done. stream_primers() only runs primer3 when we ask for the next pair,
+    so we check the Event <stop> before each one: once the consumer has
+    enough, no further round is started. The queue is bounded, a job that
+    is too far ahead of the consumer waits.
+    '''
+    def put(x):
+        # Don't block on a full queue once nobody reads it anymore
+        while not stop.is_set():
+            try:
+                queue.put(x, timeout=0.1)
+                return True
+            except Full:
+                continue
+        return False
+
+    stream = stream_primers(masked, constraints, params)
+    try:
+        while not stop.is_set():
+            try:
+                p = next(stream)
+            except StopIteration:
+                break
+            if not put(p):
+                break
+    finally:
+        put(None)
+    return None
+
+
+class DesignPool():
+    '''
+    Run independent design jobs, eg the constraints left and right of the
+    exon in qPCR or the "Design first" pass of the blind search, on a pool of
+    processes and stream the pairs in the order of the jobs.
+
+    pool = DesignPool(4)
+    for p in pool.iter([(masked, constraints), (nomask, constraints)], params):
+        ...
+    # <primers SNVs first>, then <primers design first>
+
+    The processes are started on first use and then kept around, so only the
+    first query pays for the startup. A single job runs inline, no pickling
+    and shipping of the template to another process.
+    '''
+    # Pairs a job may run ahead of the consumer, see iter()
+    queue_size = 10
+
+    def __init__(self, n_workers):
+        self.n_workers = n_workers
+        self.executor = None
+        self.manager = None
+
+    def __repr__(self):
+        status = 'running' if self.executor else 'idle'
+        return f'DesignPool({self.n_workers} workers, {status})'
+
+    def start(self):
+        if not self.executor:
+            # Don't fork, the Streamlit server we run in is multithreaded.
+            context = get_context('spawn')
+            self.executor = ProcessPoolExecutor(self.n_workers, mp_context=context)
+            # Queues and events the workers can get pickled, see iter()
+            self.manager = context.Manager()
+        return self.executor
+
+    def iter(self, jobs, params):
+        '''
+        Stream the pairs as the workers select them, see stream_design().
+        Pairs are handed out one job after the other, same as iter_designs()
+        (to keep the order reproducible and independent of the number of
+        workers); later jobs run ahead by at most <queue_size> pairs. Once we stop asking, the workers don't start another primer3
+        round and jobs that have not started are cancelled. On a single
+        worker (or job) we stream inline.
+        '''
+        if (len(jobs) < 2) or (self.n_workers < 2):
+            yield from iter_designs(jobs, params)
+            return
+
+        self.start()
+        stop = self.manager.Event()
+        queues = [self.manager.Queue(self.queue_size) for _ in jobs]
+        futures = [
+            self.executor.submit(stream_design, masked, c, params, q, stop)
+            for (masked, c), q in zip(jobs, queues)]
+        try:
+            for q, f in zip(queues, futures):
+                while True:
+                    try:
+                        p = q.get(timeout=0.1)
+                    except Empty:
+                        # A worker that crashed never sends None
+                        if f.done() and f.exception():
+                            raise f.exception()
+                        continue
+                    if p is None:
+                        # Raises the error of the job, if any
+                        f.result()
+                        break
+                    yield p
+        finally:
+            stop.set()
+            for f in futures:
+                f.cancel()
+
+    def shutdown(self):
+        if self.executor:
+            self.executor.shutdown()
+            self.executor = None
+            self.manager.shutdown()
+            self.manager = None
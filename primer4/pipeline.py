@@ -0,0 +1,334 @@
+'''
+Check primer pairs for specificity while primer3 is still designing them.
+
+primers = pool.iter(jobs, params)  # lazy, see primer4/parallel.py
+results, aln, seen = check_streamed(primers, fp_genome, params)
+
+Design runs in a thread and hands its pairs over through a bounded queue;
+BLAST (a subprocess) picks them up in batches, several at a time. Once
+<n_return> pairs have passed, or we have looked at <check_max_num_candidates>
+of them, we stop the design, so no primer3 round is run that we don't need.
+'''
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from heapq import heappop, heappush
+from itertools import count
+from queue import Queue, Empty, Full
+from threading import Event, Thread
+
+from primer4.backends import get_backend
+from primer4.design import check_for_multiple_amplicons, sort_by_penalty
+from primer4.kmers import load_kmer_counts
+from primer4.utils import log
+
+
+# Marks the end of the design stream
+DONE = object()
+
+
+def produce(primers, queue, stop):
+    '''
+    Feed the primer pairs into the queue until they run out or the consumer
+    has seen enough. Pairs found by several design passes (eg with and
+    without SNVs, "blind search") are only passed on once, in one pass over
+    the stream, by key(). The first copy wins: the same coordinates and
+    sequences get the same penalty from primer3, and we don't hold pairs back
+    to wait for a better copy.
+    '''
+    seen = set()
+    try:
+        for p in primers:
+            if p.key() in seen:
+                continue
+            seen.add(p.key())
+
+            while not stop.is_set():
+                try:
+                    queue.put(p, timeout=0.1)
+                    break
+                except Full:
+                    continue
+            if stop.is_set():
+                break
+
+    except Exception as e:
+        # Hand over to the consumer, which raises it in the main thread
+        queue.put(e)
+    finally:
+        # Don't leave a half run design behind, eg the pool jobs
+        if hasattr(primers, 'close'):
+            primers.close()
+        queue.put(DONE)
+
+
+def overlap(a, b):
+    '''
+    Do two primer pairs share a binding site, ie do their fwd or their rev
+    primers overlap?
+    '''
+    return any(
+        (getattr(a, x).start < getattr(b, x).end) and
+        (getattr(b, x).start < getattr(a, x).end) for x in ['fwd', 'rev'])
+
+
+class Clusters():
+    '''
+    Near-identical candidates (the same amplicon shifted by a few bases, the
+    same fwd primer with another rev primer) tend to pass or fail the
+    specificity check together. So we group candidates with overlapping
+    binding sites, check the first of each group (the representative), and
+    only check the rest if it passed.
+
+    Within a design pass, pairs never overlap (see select_pairs()), so this
+    is mostly about pairs from different passes, eg the blind search.
+
+    clusters = Clusters()
+    clusters.add(p)
+    # True if p is a new representative, otherwise p waits for its group
+    clusters.update(checked, passed)
+    clusters.ready
+    # deque of members whose representative passed
+    '''
+    def __init__(self):
+        self.reps = []
+        self.members = defaultdict(list)
+        self.passed = {}  # representative key(): None (pending), True, False
+        self.ready = deque()
+
+    def __repr__(self):
+        return f'Clusters({len(self.reps)} groups, {len(self.ready)} ready)'
+
+    def add(self, p):
+        for r in self.reps:
+            if overlap(r, p):
+                status = self.passed[r.key()]
+                if status is None:
+                    self.members[r.key()].append(p)
+                elif status:
+                    self.ready.append(p)
+                # else the group failed, skip p
+                return False
+
+        self.reps.append(p)
+        self.passed[p.key()] = None
+        return True
+
+    def update(self, checked, passed):
+        passed = set(p.key() for p in passed)
+        for p in checked:
+            k = p.key()
+            if self.passed.get(k, False) is None:
+                self.passed[k] = k in passed
+                members = self.members.pop(k, [])
+                if self.passed[k]:
+                    self.ready.extend(members)
+        return None
+
+
+class CandidatePool():
+    '''
+    Priority queue of candidates as they come out of the design, best
+    (lowest penalty) first. We only ever check <capacity> candidates, so the
+    pool never holds more than are still to be handed out, and drops the
+    worst ones. Pairs with the same penalty come out in the order they went
+    in.
+
+    pool = CandidatePool(100)
+    pool.push(p)
+    pool.pop()
+    # the best pair pushed so far
+
+    Two heaps, one for the best and one for the worst pair; a pair removed
+    from one is only marked (by its ticket) and skipped in the other, so push
+    and pop are O(log n).
+    '''
+    def __init__(self, capacity):
+        self.capacity = capacity  # how many we will still hand out
+        self.best, self.worst = [], []
+        self.gone = set()
+        self.tickets = count()
+        self.size = 0
+
+    def __repr__(self):
+        return f'CandidatePool({self.size} pairs, {self.capacity} to go)'
+
+    def __len__(self):
+        return self.size
+
+    def push(self, p):
+        if self.capacity <= 0:
+            return None
+        t = next(self.tickets)
+        heappush(self.best, (p.penalty, t, p))
+        heappush(self.worst, (-p.penalty, -t, p))
+        self.size += 1
+
+        while self.size > self.capacity:
+            _, t, _ = heappop(self.worst)
+            if -t in self.gone:
+                self.gone.discard(-t)
+            else:
+                self.gone.add(-t)
+                self.size -= 1
+        return None
+
+    def peek(self):
+        '''
+        All pairs in the pool, best first, without taking them out.
+        '''
+        return [p for _, t, p in sorted(self.best) if t not in self.gone]
+
+    def pop(self):
+        while self.best:
+            _, t, p = heappop(self.best)
+            if t in self.gone:
+                self.gone.discard(t)
+                continue
+            self.gone.add(t)
+            self.size -= 1
+            self.capacity -= 1
+            if not self.size:
+                # Drop the marked leftovers in the other heap
+                self.best, self.worst = [], []
+                self.gone = set()
+            return p
+        raise IndexError('pop from an empty pool')
+
+
+def check_streamed(primers, fp_genome, params, batch_size=10, queue_size=50, cache=None):
+    '''
+    Returns the pairs that pass in the order they were checked (by penalty
+    within each batch), the alignment lookup and the number of pairs checked.
+
+    New candidates are checked best first, as far as the design has got
+    (see CandidatePool); members of a group whose representative passed (see
+    Clusters) once the design is done. With a <cache> (see primer4/cache.py)
+    the search results (eg the BLAST hits of each oligo) are kept across
+    queries.
+
+    We keep <n_batches> batches in flight (see settings). Each search run
+    pays for loading the index, so before they fan out to their threads, the
+    new batches are searched in one go, together with the candidates lined up
+    behind them in the pool (prefetch); the threads then only pair up and
+    count the sites. Results are taken in the order the batches were started,
+    ie by penalty, and once <n_return> pairs have passed, the batches still
+    running are cancelled.
+    '''
+    mx_cand = params['primers']['check_max_num_candidates']
+    mx = params['n_return']
+    n_batches = params.get('blast', {}).get('n_batches', 1)
+
+    queue, stop = Queue(maxsize=queue_size), Event()
+    producer = Thread(target=produce, args=(primers, queue, stop), daemon=True)
+    producer.start()
+
+    clusters = Clusters()
+    pool = CandidatePool(mx_cand)
+    # blastn, isPcr or our own index, see primer4/backends.py
+    search = get_backend(params, cache)
+    # Pairs whose 3' ends occur all over the genome won't pass, so they don't
+    # take up a place in the pool (see primer4/kmers.py)
+    kmers = params.get('kmers', {})
+    counts = load_kmer_counts(kmers['path']) if kmers.get('path') else None
+    repetitive = 0
+    seen, done = 0, False
+    all_results, all_aln = [], []
+    inflight = deque()  # (batch, future), in the order they were started
+    executor = ThreadPoolExecutor(max_workers=n_batches)
+
+    def fill(block):
+        # Take whatever the design has produced so far, waiting for at least
+        # one pair if <block>.
+        nonlocal done, repetitive
+        while not done:
+            try:
+                p = queue.get(block=block)
+            except Empty:
+                return None
+            block = False
+            if p is DONE:
+                done = True
+            elif isinstance(p, Exception):
+                raise p
+            elif (counts is not None) and not counts.passes(p, kmers['mx_3prime_count']):
+                repetitive += 1
+            else:
+                pool.push(p)
+        return None
+
+    def next_batch(wait):
+        # While other batches are running, only start a full one, we rather
+        # collect their results than wait for the design.
+        fill(block=False)
+        if not wait and not done and (len(pool) + len(clusters.ready) < batch_size):
+            return []
+
+        batch = []
+        while len(batch) < batch_size:
+            fill(block=not pool)
+            if pool:
+                p = pool.pop()
+                if clusters.add(p):
+                    batch.append(p)
+            elif clusters.ready:
+                batch.append(clusters.ready.popleft())
+            else:
+                break
+        return batch
+
+    def check(batch):
+        # Comes out of the pool sorted, except for cluster members
+        return check_for_multiple_amplicons(
+            sort_by_penalty(batch), fp_genome, params, search)
+
+    try:
+        while True:
+            started = []
+            while len(inflight) + len(started) < n_batches:
+                batch = next_batch(wait=not (inflight or started))
+                if not batch:
+                    break
+                started.append(batch)
+
+            if started:
+                # Search the new batches and the pairs we will likely check
+                # next, one search run instead of one per batch.
+                search.prefetch([p for b in started for p in b] + pool.peek())
+            for batch in started:
+                if n_batches == 1:
+                    # Nothing to run alongside, no need for a thread
+                    inflight.append((batch, None))
+                else:
+                    inflight.append((batch, executor.submit(check, batch)))
+
+            if not inflight:
+                break
+
+            batch, future = inflight.popleft()
+            results, aln = check(batch) if future is None else future.result()
+            clusters.update(batch, results)
+            all_results += results
+            all_aln += aln
+            seen += len(batch)
+
+            if (len(all_results) >= mx) or (seen >= mx_cand):
+                break
+
+    finally:
+        stop.set()
+        # Don't wait for batches whose results we don't need
+        search.cancel()
+        for _, future in inflight:
+            if future is not None:
+                future.cancel()
+        executor.shutdown(wait=True)
+        # The producer might wait to put the end marker into a full queue
+        while producer.is_alive():
+            try:
+                queue.get(timeout=0.1)
+            except Empty:
+                pass
+        producer.join()
+
+    print(log(f'Checked {seen} primer pairs ({len(clusters.reps)} groups, {search.runs} searches, {search.cached} from cache, {repetitive} repetitive skipped), {len(all_results)} pass'))
+    return all_results, all_aln, seen
@@ -44,3 +44,51 @@ def pythonic_boundaries(feature):
         start = feature.start
         end = feature.end + 1
     return start, end
+
+
+class Window():
+    '''
+    The part of the template primer3 actually needs to see: Primers can only
+    bind in the OK regions (constraints['only_here'], pairs of (start, length)
+    as in SEQUENCE_PRIMER_PAIR_OK_REGION_LIST) and the amplicon cannot be
+    longer than the maximum product size, so everything else we crop.
+
+    w = Window(constraints, len(masked))
+    w.crop(masked)        # sequence to hand to primer3
+    w.constrain(constraints)  # constraints in window coordinates
+    w.start + 10          # position 10 in the window on the template
+    '''
+    def __init__(self, constraints, length):
+        (ls, ll), (rs, rl) = constraints['only_here']
+        _, mx = constraints['size_range']
+        # The left primer starts at most <mx> before the right one ends, and
+        # the right primer ends at most <mx> after the left one starts.
+        self.start = max(0, ls, rs - mx)
+        self.end = max(self.start, min(length, rs + rl, ls + ll + mx))
+
+    def __repr__(self):
+        return f'{self.start}-{self.end}'
+
+    def __len__(self):
+        return self.end - self.start
+
+    def crop(self, seq):
+        return seq[self.start:self.end]
+
+    def constrain(self, constraints):
+        '''
+        Translate OK regions and SNV positions into window coordinates.
+        Regions are clipped to the window, which primer3 would do anyway.
+        '''
+        here = []
+        for start, length in constraints['only_here']:
+            a = max(start, self.start)
+            b = min(start + length, self.end)
+            here.append((a - self.start, max(0, b - a)))
+
+        c = dict(constraints)
+        c['only_here'] = tuple(here)
+        if constraints.get('snvs'):
+            c['snvs'] = set(
+                i - self.start for i in constraints['snvs'] if self.start <= i < self.end)
+        return c
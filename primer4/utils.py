@@ -570,6 +570,8 @@ def parse_snpdb(line):
 def load_variation_freqs(feat, databases, params):
     '''
     feat .. gffutils feature type
+    databases .. dict of name: path to VCF, or an already open VariantFile,
+        eg when designing many queries in one go (see design_batch() in main)
     
     "freqs" is a dict which contains the SNVs per position.
     ...
@@ -584,7 +586,7 @@ def load_variation_freqs(feat, databases, params):
     skip = 0
 
     for name, db in databases.items():
-        variants = VariantFile(db)
+        variants = db if isinstance(db, VariantFile) else VariantFile(db)
 
         # dbSNP names chromosomes like "NC_000007.13", others like "7"
         if name != 'dbSNP':
@@ -645,12 +647,24 @@ def load_variation_freqs(feat, databases, params):
     return freqs, filt
 
 
-def mask_sequence(seq, var, mask='N', unmasked=''):
+def mask_sequence(seq, var, mask='N', unmasked='', unique=None):
+    # Mask inplace on a byte array instead of rebuilding the string per base
     if unmasked:
-        masked = ''.join([mask if ix in var else unmasked for ix, i in enumerate(seq)])
+        masked = bytearray(unmasked.upper() * len(seq), 'ascii')
     else:
-        masked = ''.join([mask if ix in var else i for ix, i in enumerate(seq)])
-    return masked.upper()
+        masked = bytearray(seq.upper(), 'ascii')
+
+    mask = ord(mask.upper())
+    for ix in var:
+        # Positions outside the sequence (eg SNVs right before it) are ignored
+        if 0 <= ix < len(masked):
+            masked[ix] = mask
+
+    # Repeats come as a boolean array, one per base (see load_mappability_()
+    # in Template); there can be a million of them, so no loop over those.
+    if unique is not None:
+        np.frombuffer(masked, dtype=np.uint8)[~unique] = mask
+    return masked.decode()
 
 
 # def reconstruct_mrna(tmp, feature_db, genome):
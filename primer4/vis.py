@@ -13,9 +13,8 @@ import numpy as np
 import pandas as pd
 import streamlit as st
 import gc as garcoll
-from primer4.models import Variant
+from primer4.models import PrimerTable, Variant
 from primer4.utils import convert_chrom, log
-from primer4.design import project_mask_onto_primers
 tmpD = '/tmp'
 pyGenomeTracksBin = '/usr/local/bin/stream_env/bin/pyGenomeTracks'
 #pyGenomeTracksBin = '/home/drukewitz/miniconda3_new/envs/primer4/bin/pyGenomeTracks'
@@ -303,57 +302,59 @@ def prepare_data_for_vis(v, tmp, primers):
 
 def primers_to_df(primers, tmp, qry, params):
     #pd.set_option("display.precision", 2)
-    l = []
-    for pair in primers:
-        _, fwd_start, fwd_end = pair.get_genomic_coords(tmp, 'fwd')
-        _, rev_start, rev_end = pair.get_genomic_coords(tmp, 'rev')
-
-        # TODO: I already did this in the recursion that designs the primers;
-        # however, for now I accept the slight code duplication. Could add
-        # this to the PrimerPair object or keep here so it is explicit.
-        d = project_mask_onto_primers(pair, tmp.mask)
-        _, dots_fwd, pos_fwd = d['fwd']
-        _, dots_rev, pos_rev = d['rev']
-
-        row = [
-            pair.name,
-            pair.penalty,
-            pair.get_amplicon_len(),
-            len(pair.data['fwd']['sequence']),
-            len(pair.data['rev']['sequence']),
-            pair.get_gc('fwd'),
-            pair.get_gc('rev'),
-            pair.data['fwd']['Tm'],
-            pair.data['rev']['Tm'],
-            pair.data['fwd']['sequence'],
-            pair.data['rev']['sequence'],
-            tmp.tx,
-            tmp.feat.attributes.get('gene')[0],
-            convert_chrom(tmp.feat.chrom, params['cn']),
-            fwd_start,
-            fwd_end,
-            rev_start,
-            rev_end,
-            *[f'c.{i}' for i in pair.get_coding_coords(tmp, 'fwd')[1:]],
-            *[f'c.{i}' for i in pair.get_coding_coords(tmp, 'rev')[1:]],
-            qry,
-            dots_fwd,
-            dots_rev,
-            #aln[(pair.name, 'fwd', tmp.feat.chrom, fwd_start, fwd_end)],
-            #aln[(pair.name, 'rev', tmp.feat.chrom, rev_start, rev_end)],
-        ]
-
-        l.append(row)
     # Any primers found?
-    if not l:
+    if not primers:
         return pd.DataFrame()
 
-    else:
-        # TODO: Add mismatches and poistion of mm from 3' end
-        df = pd.DataFrame(l)
-        df.columns = 'name,penalty,amplicon,fwd len,rev len,fwd GC,rev GC,fwd Tm,rev Tm,fwd 5>3,rev 5>3,transcript,gene,chrom,fwd start,fwd end,rev start,rev end,fwd c. start, fwd c. end, rev c. start, rev c. end,query,aln fwd 5>3,aln rev 5>3'.split(',')    
-        # Sort df; in case of qPCR we look first left then right of exon so we
-        # get two independent sets of primers, ie df is not ordered in this case
-        df = df.sort_values('penalty')
-        return df
+    table = PrimerTable(primers)
+    # Genomic coords, same as pair.get_genomic_coords() but for all at once
+    g = {
+        x: table[x] + tmp.start + (1 if x.endswith('start') else 0) for x in
+        ['fwd_start', 'fwd_end', 'rev_start', 'rev_end']}
 
+    coding = []
+    for pair in table.primers:
+        coding.append([
+            *[f'c.{i}' for i in pair.get_coding_coords(tmp, 'fwd')[1:]],
+            *[f'c.{i}' for i in pair.get_coding_coords(tmp, 'rev')[1:]],
+            ])
+    coding = list(zip(*coding))
+
+    amplicon = table['rev_end'] - table['fwd_start'] - table['offset']
+
+    # TODO: I already did this in the recursion that designs the primers;
+    # however, for now I accept the slight code duplication.
+    dots_fwd, dots_rev = table.dots(tmp.mask)
+
+    # TODO: Add mismatches and poistion of mm from 3' end
+    df = pd.DataFrame({
+        'name': table['name'],
+        'penalty': table['penalty'],
+        'amplicon': amplicon,
+        'fwd len': table['fwd_len'],
+        'rev len': table['rev_len'],
+        'fwd GC': table['fwd_GC'],
+        'rev GC': table['rev_GC'],
+        'fwd Tm': table['fwd_Tm'],
+        'rev Tm': table['rev_Tm'],
+        'fwd 5>3': table['fwd_seq'],
+        'rev 5>3': table['rev_seq'],
+        'transcript': tmp.tx,
+        'gene': tmp.feat.attributes.get('gene')[0],
+        'chrom': convert_chrom(tmp.feat.chrom, params['cn']),
+        'fwd start': g['fwd_start'],
+        'fwd end': g['fwd_end'],
+        'rev start': g['rev_start'],
+        'rev end': g['rev_end'],
+        'fwd c. start': coding[0],
+        ' fwd c. end': coding[1],
+        ' rev c. start': coding[2],
+        ' rev c. end': coding[3],
+        'query': qry,
+        'aln fwd 5>3': dots_fwd,
+        'aln rev 5>3': dots_rev,
+        })
+    # Sort df; in case of qPCR we look first left then right of exon so we
+    # get two independent sets of primers, ie df is not ordered in this case
+    df = df.sort_values('penalty')
+    return df
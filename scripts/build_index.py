@@ -0,0 +1,30 @@
+'''
+Build the index for in-silico PCR without BLAST (see primer4/index.py) from
+the reduced genome:
+
+python scripts/prep_genome_4blast.py --genome GRCh38_latest_genomic.fna --out redux.fna
+python scripts/build_index.py --genome redux.fna --out redux.p4i
+'''
+import argparse
+
+import screed
+
+from primer4.index import build_index
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    '--genome', default='redux.fna', required=True,
+    help='Reference genome, eg from prep_genome_4blast.py')
+parser.add_argument(
+    '--out', default='redux.p4i', help='Name of the index (a directory)')
+parser.add_argument(
+    '-k', default=13, type=int,
+    help='Length of the k-mers we look up, at most the 3\' matches we require')
+args = parser.parse_args()
+
+
+with screed.open(args.genome) as file:
+    # Contig names are the accession, like BLAST reports them
+    contigs = ((line.name.split(' ')[0], line.sequence) for line in file)
+    build_index(contigs, args.out, k=args.k)
@@ -0,0 +1,29 @@
+'''
+Build the table of 3' k-mer counts (see primer4/kmers.py) from the reduced
+genome:
+
+python scripts/prep_genome_4blast.py --genome GRCh38_latest_genomic.fna --out redux.fna
+python scripts/build_kmer_counts.py --genome redux.fna --out redux.k15.npy
+'''
+import argparse
+
+import screed
+
+from primer4.kmers import build_kmer_counts
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    '--genome', default='redux.fna', required=True,
+    help='Reference genome, eg from prep_genome_4blast.py')
+parser.add_argument(
+    '--out', default='redux.k15.npy', help='Name of the table (.npy)')
+parser.add_argument(
+    '-k', default=15, type=int,
+    help='Length of the k-mers, usually the 3\' matches we require')
+args = parser.parse_args()
+
+
+with screed.open(args.genome) as file:
+    contigs = ((line.name.split(' ')[0], line.sequence) for line in file)
+    build_kmer_counts(contigs, args.out, k=args.k)
@@ -0,0 +1,36 @@
+'''
+Build the mappability track (see MappabilityTrack in primer4/kmers.py) from
+the reduced genome:
+
+python scripts/prep_genome_4blast.py --genome GRCh38_latest_genomic.fna --out redux.fna
+python scripts/build_mappability.py --genome redux.fna --out redux.k24.map
+
+This counts all k-mers of the genome exactly, so it needs disk space for
+them (8 bytes per base) and takes a while.
+'''
+import argparse
+
+import screed
+
+from primer4.kmers import build_mappability
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    '--genome', default='redux.fna', required=True,
+    help='Reference genome, eg from prep_genome_4blast.py')
+parser.add_argument(
+    '--out', default='redux.k24.map', help='Name of the track (a directory)')
+parser.add_argument(
+    '-k', default=24, type=int,
+    help='Length of the k-mers, about the length of a primer')
+parser.add_argument(
+    '--parts', default=64, type=int,
+    help='Number of partitions to count in, more need less memory')
+args = parser.parse_args()
+
+
+with screed.open(args.genome) as file:
+    # Contig names are the accession, like in the annotation
+    contigs = ((line.name.split(' ')[0], line.sequence) for line in file)
+    build_mappability(contigs, args.out, k=args.k, n_parts=args.parts)
@@ -1,7 +1,17 @@
 '''
 Remove duplicate sequences from reference genome which might cause Blast to erroneously identify multimappings during primer validation.
+
+Optionally split the genome into shards, which are searched at the same
+time (see stream_shards() in primer4/design.py):
+
+python prep_genome_4blast.py --genome GRCh38_latest_genomic.fna --out redux.fna --shards 8
+for i in redux.shard*.fna; do makeblastdb -in $i -dbtype nucl; done
+
+and set "shards": "redux.fna.shards.json" in the blast settings.
 '''
 import argparse
+import json
+from pathlib import Path
 
 import screed
 
@@ -11,7 +21,13 @@ parser.add_argument(
     '--genome', default='GRCh37_latest_genomic.fna', required=True,
     help='Reference genome from NCBI')
 parser.add_argument(
-    '--out', default='4blast.fna', help='Name outfile')  
+    '--out', default='4blast.fna', help='Name outfile')
+parser.add_argument(
+    '--shards', default=0, type=int,
+    help='Also split the genome into this many shards of about equal size')
+parser.add_argument(
+    '--per-chromosome', action='store_true',
+    help='Also split the genome into one shard per sequence')
 args = parser.parse_args()
 
 
@@ -21,9 +37,55 @@ exclude = set([
     'alternate locus group',
     ])
 
+
+def balance(sizes, n):
+    '''
+    Assign sequences to n shards, largest first, each to the shard with the
+    fewest bases so far.
+
+    balance({'chr1': 248, 'chr2': 242, 'chr21': 46, 'chr22': 50}, 2)
+    # {'chr1': 0, 'chr2': 1, 'chr22': 1, 'chr21': 0}
+    '''
+    load = [0] * n
+    shards = {}
+    for name, size in sorted(sizes.items(), key=lambda x: -x[1]):
+        i = load.index(min(load))
+        shards[name] = i
+        load[i] += size
+    return shards
+
+
+sizes = {}
 with screed.open(args.genome) as file, open(args.out, 'w+') as out:
     for line in file:
         if any([i in line.name for i in exclude]):
             continue
         else:
             out.write(f'>{line.name}\n{line.sequence}\n')
+            sizes[line.name] = len(line.sequence)
+
+
+if args.shards or args.per_chromosome:
+    n = len(sizes) if args.per_chromosome else min(args.shards, len(sizes))
+    assignment = balance(sizes, n)
+
+    out = Path(args.out)
+    names = [f'{out.stem}.shard{i:03d}{out.suffix}' for i in range(n)]
+    files = [open(out.parent / i, 'w+') for i in names]
+    # Second pass, we don't want to hold the genome in memory
+    with screed.open(args.out) as file:
+        for line in file:
+            files[assignment[line.name]].write(f'>{line.name}\n{line.sequence}\n')
+    for f in files:
+        f.close()
+
+    # Paths relative to the manifest, so the data directory can move; blastn
+    # gets the length of the whole genome (-dbsize) for each shard
+    manifest = {'genome': out.name, 'dbsize': sum(sizes.values()), 'shards': [
+        {
+            'index': name,
+            'contigs': [k for k, v in assignment.items() if v == i],
+            'size': sum(sizes[k] for k, v in assignment.items() if v == i),
+        } for i, name in enumerate(names)]}
+    with open(f'{args.out}.shards.json', 'w+') as file:
+        json.dump(manifest, file, indent=4)
@@ -20,12 +20,38 @@ params = {
         "mx_amplicon_len": 4000,
         "mx_amplicon_n": 1
     },
+    "design": {
+        "n_workers": 4
+    },
+    "cache": {
+        "path": "/mnt/data/primer4_cache.sqlite",
+        "max_size_mb": 500
+    },
     "blast": {
         "word_size": 13,
         "mx_evalue": 5,
         "n_cpus": 8,
+        "n_batches": 4,
         "mx_blast_hits": 10000,
-        "index": "/mnt/data/redux.fna"
+        "index": "/mnt/data/redux.fna",
+        "shards": None
+    },
+    "specificity": {
+        "backend": "blast"
+    },
+    "ispcr": {
+        "index": "/mnt/data/redux.2bit"
+    },
+    "index": {
+        "path": None,
+        "mx_mismatches": 2
+    },
+    "kmers": {
+        "path": None,
+        "mx_3prime_count": 100
+    },
+    "mappability": {
+        "path": None
     },
     "n_return": 10,
     "burnin_sanger": 30,
@@ -0,0 +1,56 @@
+import pytest
+
+from primer4.backends import BACKENDS, IsPcrBackend, get_backend, parse_ispcr
+from primer4.design import BlastSearch, check_for_multiple_amplicons
+from primer4.models import PrimerPair
+
+
+fwd, rev = 'ACGTCTGAAAATGACCCTCA', 'TTGAGCAACCGCAGAC'
+ispcr = f'''>chr17:1001+1066 pair0 66bp {fwd} {rev}
+{fwd}atcatagccagaaacgtaccg
+gtacgtactGTCTGCGGTTGCTCAA
+>chr3:501-566 pair0 66bp {fwd} {rev}
+{fwd[:-1]}TatcatagccagaaacgtaccggtacgtactGTCTGCGGTTGCTCAA
+>chr17:2001+2066 pair1 66bp {fwd} {rev}
+{fwd}atcatagccagaaacgtaccggtacgtactGTCTGCGGTTGCTCAA
+'''
+
+
+def test_parse_ispcr():
+    products = parse_ispcr(ispcr)
+    assert [(p.contig, p.start, p.end, p.strand) for p in products['pair0']] == [
+        ('chr17', 1001, 1066, '+'), ('chr3', 501, 566, '-')]
+    assert len(products['pair0'][0].sequence) == 66
+    with pytest.raises(ValueError):
+        parse_ispcr('>something else\nACGT\n')
+
+
+def test_ispcr_backend(monkeypatch):
+    monkeypatch.setattr(
+        'primer4.backends.run_ispcr', lambda queries, params, stop: parse_ispcr(ispcr))
+    pair = PrimerPair({
+        'fwd': {'start': 0, 'end': 20, 'sequence': fwd},
+        'rev': {'start': 44, 'end': 60, 'sequence': rev},
+        'penalty': 0,
+        })
+    params = {'primers': {'mx_amplicon_n': 1, 'mx_amplicon_len': 4000}}
+    search = IsPcrBackend(params)
+
+    # Two products, the second on the minus strand w/ a 3' mismatch
+    results, _ = check_for_multiple_amplicons([pair], None, params, search)
+    assert not results and search.amplicons(pair) == 2
+    aln = search.sites(pair)
+    assert aln[(pair.name, 'fwd', 'chr17', 1001, 1020)] == '.' * 20
+    assert aln[(pair.name, 'rev', 'chr17', 1051, 1066)] == '.' * 16
+    assert aln[(pair.name, 'fwd', 'chr3', 547, 566)] == '.' * 19 + '|'
+
+
+def test_get_backend():
+    params = {'index': {'path': None}}
+    assert isinstance(get_backend(params), BlastSearch)
+    params['specificity'] = {'backend': 'ispcr'}
+    assert isinstance(get_backend(params), IsPcrBackend)
+    params['specificity'] = {'backend': 'bowtie'}
+    with pytest.raises(ValueError):
+        get_backend(params)
+    assert set(BACKENDS) == {'blast', 'ispcr', 'index'}
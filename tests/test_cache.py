@@ -0,0 +1,52 @@
+from primer4.cache import DiskCache, design_key, ispcr_key
+
+
+def test_disk_cache(tmp_path):
+    cache = DiskCache(str(tmp_path / 'cache.sqlite'), max_size=2000)
+    assert not cache.validate('data v1')
+
+    cache.set('a', 'A' * 900)
+    cache.set('b', 'B' * 900)
+    assert cache.get('a') == 'A' * 900  # a is now more recent than b
+    cache.set('c', 'C' * 900)           # too large, evict least recently used
+    assert cache.get('b') is None
+    assert cache.get('a') and cache.get('c')
+
+    # The running total matches the table, also after replacing an entry and
+    # when opened again
+    cache.set('a', 'A' * 10)
+    assert cache.total == cache.size()
+    assert DiskCache(str(tmp_path / 'cache.sqlite'), max_size=2000).total == cache.size()
+
+    # Same data, keep entries; new data, drop them
+    assert cache.validate('data v1') and len(cache) == 2
+    assert not cache.validate('data v2') and len(cache) == 0
+
+
+def test_design_key():
+    params = {'n_return': 10, 'blast': {'n_cpus': 8, 'word_size': 13}}
+    key = design_key('Sanger', ['NM_000546.6:c.215C>G '], params, 0.01, False)
+
+    params['blast']['n_cpus'] = 2
+    assert key == design_key('sanger', ['NM_000546.6:c.215C>G'], params, 0.01, False)
+
+    params['blast']['word_size'] = 11
+    assert key != design_key('sanger', ['NM_000546.6:c.215C>G'], params, 0.01, False)
+    assert key != design_key('sanger', ['NM_000546.6:c.215C>G'], params, 0.02, False)
+
+
+def test_ispcr_key():
+    pair = ('ACGTCTGAAAATGACCCTCA', 'TTGAGCAACCGCAGAC')
+    params = {
+        'ispcr': {'index': 'redux.2bit'},
+        'blast': {'word_size': 13},
+        'primers': {'mx_amplicon_len': 4000, 'mn_3prime_matches': 15},
+        }
+    key = ispcr_key(pair, params)
+
+    # BLAST settings don't matter for isPcr, the product size does
+    params['blast']['word_size'] = 11
+    assert key == ispcr_key(pair, params)
+    params['primers']['mx_amplicon_len'] = 2000
+    assert key != ispcr_key(pair, params)
+    assert ispcr_key(pair[::-1], params) != ispcr_key(pair, params)
@@ -1,8 +1,31 @@
+from concurrent.futures import CancelledError
+import json
+import os
 import re
+import subprocess
+from threading import Event, Timer
 
+import pandas as pd
 import pytest
 
-from primer4.design import parse_blast_btop
+from primer4 import design
+from primer4.cache import DiskCache
+from primer4.design import (
+    BlastSearch,
+    blast_frame,
+    check_for_multiple_amplicons,
+    count_products,
+    design_session,
+    parse_blast_btop,
+    project_mask_onto_primers,
+    select_pairs,
+    sort_by_penalty,
+    stream_blast,
+    stream_primers,
+    stream_shards,
+    )
+from primer4.models import PrimerPair, PrimerTable
+from primer4.space import Window
 
 
 # https://www.ncbi.nlm.nih.gov/books/NBK569862/
@@ -21,3 +44,285 @@ testdata = [
 def test_parse_blast_btop(query, split, aln):
      a, b = parse_blast_btop(query, debug=True)
      assert a == aln and b == split
+
+
+def pair(fwd, rev, template):
+    # Mock candidate at (start, end) positions on the template
+    return PrimerPair({
+        'fwd': {'start': fwd[0], 'end': fwd[1], 'sequence': template[fwd[0]:fwd[1]]},
+        'rev': {'start': rev[0], 'end': rev[1], 'sequence': template[rev[0]:rev[1]]},
+        'penalty': 0,
+        })
+
+
+def test_select_pairs():
+    template = 'A' * 100
+    candidates = [
+        pair((0, 10), (80, 90), template),
+        pair((20, 30), (60, 70), template),
+        # overlaps the first pair, which would be masked
+        pair((5, 15), (50, 60), template),
+        pair((35, 45), (90, 100), template),
+        ]
+
+    masked = bytearray(template, 'ascii')
+    selected, complete, n_masked = select_pairs(
+        candidates, masked, set(), mn_3prime_matches=5)
+    assert selected == candidates[:2] and not complete
+    assert n_masked == 40 and masked.count(b'N') == 40
+
+    # SNV in the 3' end of the fwd primer
+    masked = bytearray(template, 'ascii')
+    selected, complete, n_masked = select_pairs(
+        candidates[:2], masked, {28}, mn_3prime_matches=5)
+    assert selected == candidates[:1] and not complete
+    assert n_masked == 21 and masked[28] == ord('N')
+
+
+signature = 'only_here, size_range, window'
+testdata = [
+    (((0, 400), (600, 400)), (350, 600), (0, 1000)),
+    (((0, 5000), (5300, 4700)), (350, 600), (4700, 5600)),
+    (((100, 50), (200, 50)), (80, 150), (100, 250)),
+    # No room left for the left primer (see stream_primers())
+    (((100, 50), (300, 50)), (80, 150), (150, 300)),
+    ]
+
+@pytest.mark.parametrize(signature, testdata)
+def test_window(only_here, size_range, window):
+    constraints = {'only_here': only_here, 'size_range': size_range}
+    w = Window(constraints, 10000)
+    assert (w.start, w.end) == window
+
+
+def test_design_session():
+    from settings.credentials import params
+
+    # Same settings, same session
+    assert design_session(params) is design_session(dict(params))
+    assert design_session(params) is not design_session({**params, 'tm_max': 65.})
+
+    with pytest.raises(ValueError):
+        design_session({**params, 'tm_opt': 70.})
+
+
+def test_design_session_rounds(monkeypatch):
+    import random
+    import primer3
+    from settings.credentials import params
+
+    # Record which calls come with the globals; the fake primer3 keeps them
+    # like primer3-py 0.6.x does
+    calls, installed = [], {}
+    design_primers = primer3.bindings.designPrimers
+    def fake(seq_args, global_args=None):
+        calls.append(global_args is not None)
+        installed.update(global_args or {})
+        return design_primers(seq_args, installed)
+    monkeypatch.setattr(primer3.bindings, 'designPrimers', fake)
+    monkeypatch.setattr(design.DesignSession, 'keeps_globals', True)
+    monkeypatch.setattr(design.DesignSession, 'installed', None)
+
+    random.seed(3)
+    template = ''.join(random.choices('ACGT', k=3000))
+    constraints = {
+        'only_here': ((100, 400), (1500, 400)),
+        'size_range': (1000, 2000),
+        'snvs': set(range(0, 3000, 37)),
+        }
+    primers = list(stream_primers(template, constraints, params, mx_pairs=20))
+    # Several rounds, the globals only go to primer3 in the first
+    assert primers and len(calls) > 1 and calls == [True] + [False] * (len(calls) - 1)
+
+
+def test_primer_pair():
+    import pickle
+
+    a = pair((0, 10), (80, 90), 'ACGT' * 25)
+    b = pickle.loads(pickle.dumps(pair((0, 10), (80, 90), 'ACGT' * 25)))
+    # Same coordinates and sequences, same name
+    assert a.name == b.name and a.data == b.data
+    assert a.name != pair((0, 10), (81, 91), 'ACGT' * 25).name
+    assert a.get_amplicon_len() == 90 and a.get_gc('fwd') == 0.5
+
+    # Names are short digests; distinct pairs that share one are both kept
+    c = pair((0, 10), (81, 91), 'ACGT' * 25)
+    c.name = a.name
+    assert len(sort_by_penalty([a, b, c])) == 2
+
+
+def test_primer_table():
+    template = 'ACGT' * 50
+    candidates = [
+        pair((0, 20), (100, 120), template),
+        pair((30, 50), (150, 170), template),
+        pair((60, 80), (170, 190), template),
+        ]
+    for c, penalty in zip(candidates, [3, 1, 2]):
+        c.penalty = penalty
+
+    table = PrimerTable(candidates)
+    assert table.sort().primers == [candidates[i] for i in [1, 2, 0]]
+
+    mask = {2, 45, 105, 189}
+    valid_fwd, valid_rev = table.snv_free(mask, mn_3prime_matches=15)
+    for c, f, r, df, dr in zip(candidates, valid_fwd, valid_rev, *table.dots(mask)):
+        d = project_mask_onto_primers(c, mask, mn_3prime_matches=15)
+        assert (d['fwd'][0], d['rev'][0], d['fwd'][1], d['rev'][1]) == (f, r, df, dr)
+
+
+def test_count_products():
+    def hits(*rows):
+        return pd.DataFrame(rows, columns=['sseqid', 'sstrand', 'sstart', 'send'])
+
+    fwd = hits(('c1', 'plus', 100, 120), ('c1', 'minus', 9020, 9000), ('c2', 'plus', 100, 120))
+    rev = hits(
+        ('c1', 'minus', 500, 480),  # product w/ fwd on plus
+        ('c1', 'minus', 5000, 4980),  # too far
+        ('c1', 'plus', 8700, 8720),  # product w/ fwd on minus
+        ('c1', 'plus', 9100, 9120),  # wrong orientation
+        ('c3', 'minus', 500, 480),  # other contig
+        )
+    assert count_products(fwd, rev, 4000) == 2
+    # Only count until the pair is rejected
+    fwd = pd.concat([hits(('c0', 'plus', 100, 120)), fwd])
+    rev = pd.concat([hits(('c0', 'minus', 500, 480)), rev])
+    assert count_products(fwd, rev, 4000) == 3
+    assert count_products(fwd, rev, 4000, stop=0) == 1
+
+
+def blastn_row(name, oligo, btop, sseqid='c1', sstart=101):
+    n = len(oligo)
+    return [name, sseqid, n, 10**6, 100., n, 0, 0, 1, n, sstart, sstart + n - 1, 1e-3, 40., n, btop, 'plus']
+
+
+def test_stream_blast(tmp_path, monkeypatch):
+    # Fake blastn: two hits for the first query, one of which can't bind
+    # (3' mismatch), and one for the second
+    rows = [
+        blastn_row('a', 'A' * 20, '20'),
+        blastn_row('a', 'A' * 20, '18AC1'),
+        blastn_row('b', 'C' * 20, '3AC16'),
+        ]
+    out = tmp_path / 'hits.tsv'
+    out.write_text(''.join('\t'.join(map(str, r)) + '\n' for r in rows))
+    blastn = tmp_path / 'blastn'
+    blastn.write_text(f'#!/bin/sh\ncat > /dev/null\ncat {out}\n')
+    blastn.chmod(0o755)
+    monkeypatch.setenv('PATH', f'{tmp_path}:{os.environ["PATH"]}')
+
+    params = {
+        'blast': {'word_size': 13, 'mx_evalue': 5, 'index': 'redux', 'n_cpus': 1},
+        'primers': {'mn_3prime_matches': 15},
+        }
+    found = dict(stream_blast({'a': 'A' * 20, 'b': 'C' * 20}, params))
+    assert list(found['a']['btop']) == ['20'] and list(found['b']['aln']) == ['...|' + '.' * 16]
+
+    blastn.write_text('#!/bin/sh\necho "BLAST Database error" >&2\nexit 2\n')
+    with pytest.raises(subprocess.CalledProcessError):
+        list(stream_blast({'a': 'A' * 20}, params))
+
+    # Cancelled while blastn is busy (eg loading the index)
+    blastn.write_text('#!/bin/sh\nexec sleep 10\n')
+    stop = Event()
+    Timer(0.2, stop.set).start()
+    with pytest.raises(CancelledError):
+        list(stream_blast({'a': 'A' * 20}, params, stop))
+
+
+def test_stream_shards(tmp_path, monkeypatch):
+    # Fake blastn: one hit per query, on a contig named after the shard and
+    # the size of the database
+    blastn = tmp_path / 'blastn'
+    blastn.write_text(
+        '#!/bin/sh\n'
+        'while [ $# -gt 0 ]; do\n'
+        '  case $1 in -db) db=$(basename $2);; -dbsize) size=$2;; esac; shift\n'
+        'done\n'
+        'grep ">" | tr -d ">" | while read q; do\n'
+        '  printf "$q\\t$db:$size\\t20\\t1000\\t100\\t20\\t0\\t0\\t1\\t20\\t101\\t120\\t1e-5\\t40\\t20\\t20\\tplus\\n"\n'
+        'done\n')
+    blastn.chmod(0o755)
+    monkeypatch.setenv('PATH', f'{tmp_path}:{os.environ["PATH"]}')
+
+    manifest = tmp_path / 'redux.fna.shards.json'
+    manifest.write_text(json.dumps({'dbsize': 3000, 'shards': [
+        {'index': 'redux.shard000.fna', 'size': 2000},
+        {'index': 'redux.shard001.fna', 'size': 1000}]}))
+    params = {
+        'blast': {'word_size': 13, 'mx_evalue': 5, 'index': 'redux', 'n_cpus': 4, 'shards': str(manifest)},
+        'primers': {'mn_3prime_matches': 15},
+        }
+    # Each query once, with the hits from both shards
+    hits = [(name, sorted(df['sseqid'])) for name, df in stream_shards({'a': 'A' * 20, 'b': 'C' * 20}, params)]
+    assert hits == [
+        ('a', ['redux.shard000.fna:3000', 'redux.shard001.fna:3000']),
+        ('b', ['redux.shard000.fna:3000', 'redux.shard001.fna:3000'])]
+
+
+def test_blast_search(tmp_path, monkeypatch):
+    searched = []
+    def stream_blast(queries, params, stop=None):
+        # One hit per oligo
+        searched.extend(queries.values())
+        for k, v in queries.items():
+            yield k, blast_frame([blastn_row(k, v, str(len(v)))])
+    monkeypatch.setattr(design, 'stream_blast', stream_blast)
+
+    params = {
+        'blast': {'word_size': 13, 'mx_evalue': 5, 'index': 'redux'},
+        'primers': {'mn_3prime_matches': 15, 'mx_amplicon_len': 4000, 'mx_amplicon_n': 1},
+        }
+    template = 'ACGTTGCA' * 25
+    a = pair((0, 20), (100, 120), template)
+    b = pair((0, 20), (150, 170), template)  # same fwd primer
+
+    cache = DiskCache(str(tmp_path / 'cache.sqlite'), max_size=2**20)
+    search = BlastSearch(params, cache)
+    search.prefetch([a, b])
+    assert len(searched) == 3 and search.runs == 1
+    assert list(search.oligo_sites(a.fwd.sequence)['sseqid']) == ['c1']
+
+    # Another query, same oligos: nothing left to search
+    search = BlastSearch(params, cache)
+    results, aln = check_for_multiple_amplicons([b], None, params, search)
+    assert len(searched) == 3 and search.runs == 0 and search.cached == 2
+    assert results == [b] and (b.name, 'fwd', 'c1', 101, 120) in aln
+
+
+def test_blast_search_rejects(monkeypatch):
+    fwd, rev, other = 'ACGT' * 5, 'TTGCA' * 4, 'GGCAT' * 4
+    def site(name, oligo, contig, strand):
+        row = blastn_row(name, oligo, '20', sseqid=contig)
+        if strand == 'minus':
+            row[10:12], row[16] = [300, 281], 'minus'
+        return row
+    # fwd and rev make a product on two contigs, fwd and other on one
+    sites = {
+        fwd: [('c1', 'plus'), ('c2', 'plus')],
+        rev: [('c1', 'minus'), ('c2', 'minus')],
+        other: [('c1', 'minus')],
+        }
+    searched = []
+    def stream_blast(queries, params, stop=None):
+        searched.extend(queries.values())
+        for k, v in queries.items():
+            yield k, blast_frame([site(k, v, *x) for x in sites[v]])
+    monkeypatch.setattr(design, 'stream_blast', stream_blast)
+
+    params = {
+        'blast': {'word_size': 13, 'mx_evalue': 5, 'index': 'redux'},
+        'primers': {'mn_3prime_matches': 15, 'mx_amplicon_len': 4000, 'mx_amplicon_n': 1},
+        }
+    a = PrimerPair({'fwd': {'start': 0, 'end': 20, 'sequence': fwd}, 'rev': {'start': 180, 'end': 200, 'sequence': rev}, 'penalty': 0})
+    b = PrimerPair({'fwd': {'start': 0, 'end': 20, 'sequence': fwd}, 'rev': {'start': 180, 'end': 200, 'sequence': other}, 'penalty': 1})
+
+    # Rejected as soon as both hits are in, and their hits are dropped
+    search = BlastSearch(params)
+    search.prefetch([a])
+    assert search.amplicons(a) == 2 and not search.oligos
+
+    # fwd comes back with another partner, rev is not searched again
+    results, _ = check_for_multiple_amplicons([a, b], None, params, search)
+    assert results == [b] and sorted(searched) == sorted([fwd, rev, fwd, other])
+    assert set(search.oligos) == {fwd, other}
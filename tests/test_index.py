@@ -0,0 +1,124 @@
+import random
+
+import numpy as np
+import pytest
+
+from primer4.backends import IndexBackend
+from primer4.design import check_for_multiple_amplicons
+from primer4.index import GenomeIndex, build_index, count_amplicons
+from primer4.kmers import KmerCounts, MappabilityTrack, build_kmer_counts, build_mappability
+from primer4.models import PrimerPair
+from primer4.utils import mask_sequence
+
+
+def rc(seq):
+    return seq[::-1].translate(str.maketrans('ACGT', 'TGCA'))
+
+
+random.seed(42)
+contigs = {f'chr{i}': ''.join(random.choices('ACGT', k=20000)) for i in range(3)}
+oligo = contigs['chr1'][1000:1020]
+# Copy with two 5' mismatches on the minus strand of chr2, and one with a
+# mismatch in the 3' end, which doesn't count
+x = contigs['chr2']
+# (complement of the first two bases)
+x = x[:5000] + rc(rc(oligo[:2])[::-1] + oligo[2:]) + x[5020:]
+x = x[:9000] + oligo[:-1] + 'N' + x[9020:]
+contigs['chr2'] = x
+
+
+@pytest.fixture(scope='module')
+def index(tmp_path_factory):
+    fp = tmp_path_factory.mktemp('index') / 'redux.p4i'
+    # Small chunks to place positions across chunk boundaries
+    build_index(contigs.items(), fp, k=8, chunk_size=5000)
+    return GenomeIndex(fp)
+
+
+def test_sites(index):
+    sites = index.sites(oligo, mn_3prime_matches=15, mx_mismatches=2)
+    assert [(s.contig, s.start, s.end, s.strand, s.aln) for s in sites] == [
+        ('chr1', 1001, 1020, 'plus', '.' * 20),
+        ('chr2', 5001, 5020, 'minus', '||' + '.' * 18)]
+
+    sites = index.sites(oligo, mn_3prime_matches=15, mx_mismatches=1)
+    assert len(sites) == 1
+
+
+def test_index_backend(index):
+    seq = contigs['chr0']
+    pair = PrimerPair({
+        'fwd': {'start': 500, 'end': 520, 'sequence': seq[500:520]},
+        'rev': {'start': 880, 'end': 900, 'sequence': rc(seq[880:900])},
+        'penalty': 0,
+        })
+    params = {
+        'primers': {'mx_amplicon_len': 4000, 'mx_amplicon_n': 1, 'mn_3prime_matches': 15},
+        'index': {'mx_mismatches': 2},
+        'blast': {'mx_blast_hits': 10000},
+        }
+    search = IndexBackend(params, index=index)
+    results, aln = check_for_multiple_amplicons([pair], None, params, search)
+    assert results == [pair]
+    assert aln[(pair.name, 'fwd', 'chr0', 501, 520)] == '.' * 20
+
+    # Same fwd primer, another rev primer: only the new oligo is searched
+    other = PrimerPair({
+        'fwd': pair.data['fwd'],
+        'rev': {'start': 980, 'end': 1000, 'sequence': rc(seq[980:1000])},
+        'penalty': 0,
+        })
+    results, _ = check_for_multiple_amplicons([other], None, params, search)
+    assert results == [other] and search.runs == 3
+
+
+def test_count_amplicons():
+    # Two contigs of 3000 bp, the second starts at 3001 (one separator base)
+    starts = np.array([0, 3001])
+    fwd = (np.array([2900]), np.array([True]), 20)  # end of chrA, plus
+    rev = (np.array([3001 + 50]), np.array([False]), 16)  # start of chrB, minus
+    assert count_amplicons(fwd, rev, 4000, starts) == 0
+
+    # Same rev oligo, fwd on chrB
+    fwd = (np.array([2900, 3001 + 10]), np.array([True, True]), 20)
+    assert count_amplicons(fwd, rev, 4000, starts) == 1
+
+
+def test_kmer_counts(tmp_path):
+    fp = tmp_path / 'redux.k8.npy'
+    build_kmer_counts(contigs.items(), fp, k=8, chunk_size=5000)
+    counts = KmerCounts(fp)
+    assert counts.k == 8
+
+    # Compare to counting by hand, on both strands
+    genome = '|'.join(contigs.values())
+    for seq in [oligo, contigs['chr0'][700:720], 'A' * 20]:
+        kmer = seq[-8:]
+        expected = sum(
+            genome[i:i + 8] in (kmer, rc(kmer)) for i in range(len(genome)))
+        assert counts.count(seq) == min(expected, 255)
+
+
+def test_mappability(tmp_path):
+    build_mappability(contigs.items(), tmp_path / 'redux.map', k=12, n_parts=4, chunk_size=4096)
+    track = MappabilityTrack(tmp_path / 'redux.map')
+
+    # Compare to counting by hand, on both strands
+    genome = '|'.join(contigs.values())
+    def unique(seq):
+        return len(seq) == 12 and 'N' not in seq and (
+            genome.count(seq) + genome.count(rc(seq)) - (seq == rc(seq))) <= 1
+
+    seq = contigs['chr2']
+    # The copies of the oligo on chr1 and chr2 are repeats, the rest unique
+    for start, end in [(0, 50), (4990, 5030), (19990, 20010), (4093, 4100)]:
+        expected = [unique(seq[i:i + 12]) if i < len(seq) else True for i in range(start, end)]
+        assert list(track.query('chr2', start, end)) == expected
+    assert not track.query('chr1', 1000, 1009).any()
+    assert track.query('chrM', 0, 10).all()
+
+    # Repeats and SNVs both end up as N in the template for primer3
+    unique = track.query('chr2', 4990, 5030)
+    masked = mask_sequence(seq[4990:5030], {0}, unique=unique)
+    assert [i for i, x in enumerate(masked) if x == 'N'] == sorted(
+        {0} | set(i for i, x in enumerate(unique) if not x))
@@ -0,0 +1,48 @@
+import pytest
+
+# The app and its dependencies
+pytest.importorskip('streamlit')
+pytest.importorskip('st_aggrid')
+
+import main
+from primer4.cache import DiskCache, design_key
+
+
+def test_design_batch(tmp_path, monkeypatch):
+    # No data files needed: the valid queries are served from the cache, the
+    # malformed one fails while parsing, before anything is read
+    for name in ['Fasta', 'JSONDataProvider', 'VariantFile']:
+        monkeypatch.setattr(main, name, lambda *args, **kwargs: None)
+    monkeypatch.setattr(main.gffutils, 'FeatureDB', lambda *args, **kwargs: None)
+    monkeypatch.setattr(main, 'sync_tx_with_feature_db', lambda tx, db: tx)
+    cache = DiskCache(str(tmp_path / 'cache.sqlite'), max_size=2**20)
+    monkeypatch.setattr(main, 'result_cache', lambda fp, max_size_mb: cache)
+
+    params = {
+        'cn': {},
+        'version': 'hg38',
+        'data': {
+            'sequences': str(tmp_path / 'seqrepo'),
+            'reference': 'genome.fna',
+            'coordinates': 'cdot.json.gz',
+            'annotation': 'annotation.db',
+            'variation': {},
+            },
+        'blast': {'index': str(tmp_path / 'redux')},
+        'cache': {'path': str(tmp_path / 'cache.sqlite'), 'max_size_mb': 1},
+        }
+    cache.validate(main.data_fingerprint(params))
+    for code in ['NM_000546.6:c.215C>G', 'NM_000546.6:c.216C>G']:
+        cache.set(design_key('sanger', [code], params, 0., False), (['primers'], None, []))
+
+    queries = [
+        ('sanger', 'NM_000546.6:c.215C>G'),
+        ('sanger', 'NM_000546.6:c. 215C>G'),  # one typo
+        ('pcr', 'NM_000546.6:c.216C>G'),
+        ]
+    results = [(q, primers) for q, primers, _, _ in main.design_batch(queries, params)]
+    assert results == [
+        ('NM_000546.6:c.215C>G', ['primers']),
+        ('NM_000546.6:c. 215C>G', []),
+        ('NM_000546.6:c.216C>G', ['primers']),
+        ]
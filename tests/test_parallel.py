@@ -0,0 +1,27 @@
+import random
+
+from primer4.parallel import DesignPool, iter_designs
+
+
+def test_design_pool():
+    from settings.credentials import params
+
+    random.seed(1)
+    template = ''.join(random.choices('ACGT', k=3000))
+    jobs = [
+        (template, {'only_here': ((100, 400), (1500, 400)), 'size_range': (1000, 2000)}),
+        (template, {'only_here': ((200, 400), (1700, 400)), 'size_range': (1000, 2000)}),
+        ]
+    pool = DesignPool(2)
+    try:
+        # Same pairs in the same order, however many workers
+        expected = [p.name for p in iter_designs(jobs, params)]
+        assert [p.name for p in pool.iter(jobs, params)] == expected
+
+        # Stop early, the workers are told to stop and the pool stays usable
+        primers = pool.iter(jobs, params)
+        assert [next(primers).name for _ in range(3)] == expected[:3]
+        primers.close()
+        assert [p.name for p in pool.iter(jobs, params)] == expected
+    finally:
+        pool.shutdown()
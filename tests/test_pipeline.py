@@ -0,0 +1,140 @@
+from queue import Queue
+import threading
+import time
+
+from primer4 import pipeline
+from primer4.models import PrimerPair
+
+
+def mock(i, shift=0, penalty=None):
+    x = 30 * i + shift
+    return PrimerPair({
+        'fwd': {'start': x, 'end': x + 20, 'sequence': 'A' * 20},
+        'rev': {'start': x + 4000, 'end': x + 4020, 'sequence': 'T' * 20},
+        'penalty': i if penalty is None else penalty,
+        })
+
+
+class NoSearch():
+    runs = cached = 0
+    def __init__(self, params, cache=None):
+        pass
+    def prefetch(self, primers):
+        pass
+    def cancel(self):
+        pass
+
+
+def test_check_streamed(monkeypatch):
+    # Every other pair passes the specificity check
+    def check(primers, fp_genome, params, search):
+        return [p for p in primers if p.penalty % 2 == 0], {}
+    monkeypatch.setattr(pipeline, 'check_for_multiple_amplicons', check)
+    monkeypatch.setattr(pipeline, 'get_backend', NoSearch)
+
+    made = []
+    def design():
+        for i in range(1000):
+            made.append(i)
+            yield mock(i)
+    
+    params = {'n_return': 10, 'primers': {'check_max_num_candidates': 100}}
+    results, _, seen = pipeline.check_streamed(
+        design(), None, params, batch_size=10, queue_size=5)
+
+    assert [p.penalty for p in results] == list(range(0, 20, 2))
+    assert seen == 20
+    # Design stops shortly after, not after all 1000 pairs
+    assert len(made) < 50
+
+
+def test_concurrent_batches(monkeypatch):
+    # Pairs are searched before their batch goes to a thread
+    prefetched = set()
+    class Search(NoSearch):
+        def prefetch(self, primers):
+            assert threading.current_thread() is threading.main_thread()
+            prefetched.update(p.name for p in primers)
+
+    # Later batches finish first, results still come in penalty order
+    def check(primers, fp_genome, params, search):
+        assert all(p.name in prefetched for p in primers)
+        time.sleep(0.05 / (1 + primers[0].penalty // 10))
+        return [p for p in primers if p.penalty % 2 == 0], {}
+    monkeypatch.setattr(pipeline, 'check_for_multiple_amplicons', check)
+    monkeypatch.setattr(pipeline, 'get_backend', Search)
+
+    params = {
+        'n_return': 10,
+        'primers': {'check_max_num_candidates': 100},
+        'blast': {'n_cpus': 8, 'n_batches': 4},
+        }
+    results, _, seen = pipeline.check_streamed(
+        [mock(i) for i in range(200)], None, params, batch_size=10)
+    assert [p.penalty for p in results] == list(range(0, 20, 2))
+    assert seen == 20
+
+
+def test_repetitive(monkeypatch):
+    # Pairs w/ an odd penalty have a repetitive 3' end
+    class Counts():
+        def passes(self, p, mx_count):
+            return p.penalty % 2 == 0
+    monkeypatch.setattr(pipeline, 'load_kmer_counts', lambda fp: Counts())
+    checked = []
+    def check(primers, fp_genome, params, search):
+        checked.extend(primers)
+        return primers, {}
+    monkeypatch.setattr(pipeline, 'check_for_multiple_amplicons', check)
+    monkeypatch.setattr(pipeline, 'get_backend', NoSearch)
+
+    params = {
+        'n_return': 5,
+        'primers': {'check_max_num_candidates': 100},
+        'kmers': {'path': 'redux.k15.npy', 'mx_3prime_count': 100},
+        }
+    results, _, seen = pipeline.check_streamed([mock(i) for i in range(20)], None, params)
+    assert [p.penalty for p in checked] == list(range(0, 20, 2))
+
+
+def test_clusters(monkeypatch):
+    checked = []
+    def check(primers, fp_genome, params, search):
+        checked.extend(primers)
+        return [p for p in primers if p.fwd.start % 60 < 30], {}
+    monkeypatch.setattr(pipeline, 'check_for_multiple_amplicons', check)
+    monkeypatch.setattr(pipeline, 'get_backend', NoSearch)
+
+    # Each pair comes with two near-copies, shifted by a few bases
+    primers = [mock(i, shift, i + shift / 10) for i in range(10) for shift in [0, 2, 5]]
+    params = {'n_return': 100, 'primers': {'check_max_num_candidates': 100}}
+    results, _, seen = pipeline.check_streamed(primers, None, params)
+
+    # Representatives first, then the near-copies of the ones that passed
+    assert [p.fwd.start for p in checked[:10]] == [30 * i for i in range(10)]
+    assert seen == 10 + 2 * 5 and len(results) == 15
+
+
+def test_produce():
+    # Any number of copies of a pair, only the first is passed on
+    a, b, c = mock(0), mock(0), mock(1)
+    queue = Queue()
+    pipeline.produce(iter([a, c, b, mock(0)]), queue, threading.Event())
+    out = []
+    while (p := queue.get()) is not pipeline.DONE:
+        out.append(p)
+    assert out == [a, c]
+
+
+def test_candidate_pool():
+    pool = pipeline.CandidatePool(capacity=4)
+    for i, penalty in enumerate([5, 1, 3, 1, 9, 0, 7]):
+        pool.push(mock(i, penalty=penalty))
+    # Only the best 4 are kept, ties in order of arrival
+    assert len(pool) == 4
+    assert [pool.pop().fwd.start for _ in range(2)] == [150, 30]
+
+    # Two handed out, so there is room for two more
+    pool.push(mock(10, penalty=2))
+    assert len(pool) == 2
+    assert [pool.pop().penalty for _ in range(2)] == [1, 2]